@@ -0,0 +1,264 @@
+# -*- coding: utf-8 -*-
+
+# Benchmarks for gitshelve and git-issues.
+#
+# Every benchmark runs against a throwaway repository holding N issues with M
+# comments each, generated through the GitIssueSet API itself.  Each
+# operation is timed in a Python process of its own, so that its peak memory
+# is its own, both "cold", with the issue cache files of git-issues removed,
+# and "warm", after the same operation has already run once.
+#
+# Usage:
+#
+#   python b_gitissues.py                       # 1000 and 10000 issues
+#   python b_gitissues.py --issues 1000,10000,100000 --comments 2 \
+#                         --output results.json
+#
+# The results are written as JSON: one record for each size, operation and
+# state, giving the time taken, the number of Git processes started, the
+# peak resident memory of the process, and the largest peak resident memory
+# of any child process it waited for.  The latter is an upper bound on what
+# any Git child used: on Linux, a child's peak includes the memory it shared
+# with this process when it was forked, before it ran Git.
+
+import sys
+import os
+import imp
+import json
+import time
+import shutil
+import optparse
+import resource
+import platform
+import gitshelve
+
+from subprocess import Popen, PIPE
+from tempfile   import mkdtemp
+
+here        = os.path.dirname(os.path.abspath(__file__))
+issues_exec = os.path.join(here, 'git-issues')
+
+operations  = ['read_repository', 'read_repository_lazy',
+               'list', 'show', 'history', 'search', 'new', 'comment',
+               'commit']
+
+statuses    = ['new', 'TODO', 'open', 'closed']
+milestones  = [None, '1.0', '1.1', '2.0']
+
+######################################################################
+
+def load_issues():
+    """Load git-issues as a module, without running its command line."""
+    return imp.load_source('git_issues', issues_exec)
+
+class counting_popen(Popen):
+    """Counts every Git process gitshelve starts."""
+    count = 0
+
+    def __init__(self, *args, **kwargs):
+        counting_popen.count += 1
+        Popen.__init__(self, *args, **kwargs)
+
+def run_command(argv):
+    """Run a git-issues command in this process, as if from the shell, with
+    its output thrown away."""
+    stdout  = sys.stdout
+    argv_   = sys.argv
+    devnull = open(os.devnull, 'w')
+    try:
+        sys.stdout = devnull
+        sys.argv   = [issues_exec] + argv
+        try:
+            execfile(issues_exec, { '__name__': '__main__',
+                                    '__file__': issues_exec })
+        except SystemExit, e:
+            if e.code:
+                raise
+    finally:
+        sys.stdout = stdout
+        sys.argv   = argv_
+        devnull.close()
+
+def perform(operation):
+    """Perform one operation on the repository in the current directory."""
+    if operation == 'read_repository':
+        issues = load_issues()
+        gitshelve.open('issues', book_type = issues.xml_gitbook)
+    elif operation == 'read_repository_lazy':
+        issues = load_issues()
+        issues.GitIssueSet().load_state()
+    elif operation == 'list':
+        run_command(['list'])
+    elif operation == 'show':
+        run_command(['show', '1'])
+    elif operation == 'history':
+        run_command(['history', '1'])
+    elif operation == 'search':
+        run_command(['search', 'description', 'iss*'])
+    elif operation == 'new':
+        run_command(['new', 'Benchmark issue'])
+    elif operation == 'comment':
+        run_command(['comment', '1', 'Benchmark comment'])
+    elif operation == 'commit':
+        issues   = load_issues()
+        issueSet = issues.GitIssueSet().load_state()
+        issueSet.new_issue('Benchmark issue')
+        issueSet.shelf.commit('Benchmark commit\n')
+    else:
+        raise Exception("Unknown operation %s" % operation)
+
+def measure(operation):
+    """Time one operation, counting the Git processes it starts, and print
+    the result as JSON.  This is run in a process of its own."""
+    gitshelve.Popen = counting_popen
+
+    start = time.time()
+    perform(operation)
+    seconds = time.time() - start
+
+    print json.dumps({
+        'seconds':       seconds,
+        'git_processes': counting_popen.count,
+        'peak_rss_kb':
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'children_peak_rss_kb':
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss })
+
+######################################################################
+
+def generate(repository, issue_count, comment_count):
+    """Create a repository holding issue_count issues, each with
+    comment_count comments.  They are all written in a single commit."""
+    gitshelve.git('init', '-q', repository)
+    cwd = os.getcwd()
+    os.chdir(repository)
+    try:
+        gitshelve.git('config', 'user.name', 'Benchmark')
+        gitshelve.git('config', 'user.email', 'benchmark@example.com')
+
+        issues   = load_issues()
+        issueSet = issues.GitIssueSet().load_state()
+        issueSet.shelf.fast_import = True
+
+        for i in range(issue_count):
+            issue = issueSet.new_issue('Issue number %d' % i)
+            issue.status      = statuses[i % len(statuses)]
+            issue.milestone   = milestones[i % len(milestones)]
+            issue.tags        = ['tag%d' % (i % 7)]
+            issue.description = 'The description of issue %d.\n' % i
+            for j in range(comment_count):
+                issueSet.new_comment(issue, 'Comment %d on issue %d' % (j, i))
+
+        issueSet.save_state()
+    finally:
+        os.chdir(cwd)
+
+# Everything git-issues keeps in the Git directory to avoid reading the
+# issues branch again: the issue cache and index, the search index, and the
+# history of each issue.
+cache_files = ['issues', 'issues-cache', 'issues-index', 'issues-search',
+               'issues-history']
+
+def remove_caches(repository):
+    for name in cache_files:
+        path = os.path.join(repository, '.git', name)
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        elif os.path.isfile(path):
+            os.unlink(path)
+
+def run_measure(repository, operation):
+    proc = Popen([sys.executable, os.path.abspath(__file__),
+                  '--measure', operation],
+                 cwd = repository, stdout = PIPE)
+    output = proc.communicate()[0]
+    if proc.returncode != 0:
+        raise Exception("Measuring %s failed" % operation)
+    return json.loads(output.splitlines()[-1])
+
+def benchmark(issue_count, comment_count, selected, keep = False):
+    results    = []
+    repository = mkdtemp(prefix = 'b_gitissues-')
+    try:
+        start = time.time()
+        generate(repository, issue_count, comment_count)
+        results.append({ 'issues':     issue_count,
+                         'comments':   comment_count,
+                         'operation':  'generate',
+                         'state':      'cold',
+                         'seconds':    time.time() - start })
+
+        for operation in selected:
+            remove_caches(repository)
+            for state in ('cold', 'warm'):
+                result = run_measure(repository, operation)
+                result.update({ 'issues':    issue_count,
+                                'comments':  comment_count,
+                                'operation': operation,
+                                'state':     state })
+                results.append(result)
+    finally:
+        if keep:
+            print >> sys.stderr, "Repository kept in %s" % repository
+        else:
+            shutil.rmtree(repository)
+    return results
+
+def revision():
+    """Return the commit the benchmarked code was checked out from."""
+    git_dir = os.path.join(here, '.git')
+    if not os.path.isdir(git_dir):
+        return None
+    try:
+        return gitshelve.git('rev-parse', 'HEAD', repository = git_dir)
+    except gitshelve.GitError:
+        return None
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser()
+    parser.add_option("--issues", dest = "issues", default = "1000,10000",
+                      help = "the numbers of issues to benchmark with, "
+                             "separated by commas")
+    parser.add_option("--comments", dest = "comments", type = "int",
+                      default = 2, help = "the number of comments per issue")
+    parser.add_option("--operations", dest = "operations",
+                      default = ",".join(operations),
+                      help = "the operations to time, separated by commas")
+    parser.add_option("--output", dest = "output", default = None,
+                      help = "write the results to this file")
+    parser.add_option("--keep", dest = "keep", action = "store_true",
+                      default = False,
+                      help = "keep the generated repositories")
+    parser.add_option("--measure", dest = "measure", default = None,
+                      help = optparse.SUPPRESS_HELP)
+    (options, args) = parser.parse_args()
+
+    if options.measure:
+        measure(options.measure)
+        sys.exit(0)
+
+    selected = options.operations.split(',')
+    for operation in selected:
+        if operation not in operations:
+            parser.error("unknown operation %s" % operation)
+
+    results = []
+    for count in options.issues.split(','):
+        print >> sys.stderr, "Benchmarking %s issues..." % count
+        results.extend(benchmark(int(count), options.comments, selected,
+                                 options.keep))
+
+    report = { 'revision': revision(),
+               'python':   platform.python_version(),
+               'git':      gitshelve.git('--version'),
+               'results':  results }
+
+    if options.output:
+        fd = open(options.output, 'w')
+        json.dump(report, fd, indent = 2, sort_keys = True)
+        fd.close()
+    else:
+        json.dump(report, sys.stdout, indent = 2, sort_keys = True)
+        print
+
+# b_gitissues.py ends here
\ No newline at end of file
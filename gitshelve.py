@@ -17,6 +17,7 @@
 #
 #   data = gitshelve.open(branch = 'mydata', repository = '/tmp/foo')
 #   data = gitshelve.open(branch = 'mydata')  # use current repo
+#   data = gitshelve.open(branch = 'mydata', fast_import = True)
 #
 #   data['foo/bar/git.c'] = "This is some sample data."
 #
@@ -27,24 +28,61 @@
 #
 #   data.close()
 #
+# With fast_import = True, each commit is written through a single
+# `git fast-import' process instead of one Git command per blob and tree.
+# With lazy = True, each tree is only read from the repository when
+# something first reaches into it.
+# With cache_entries or cache_bytes, only that many books, or that much blob
+# data, is kept in memory once read; shelf.cache.stats() tells how well the
+# limit suits the way the shelf is used.
+# When another writer moves the branch while a commit is made, the changes
+# of the shelf are made again on top of the other writer's commit, unless
+# both changed the same path, which raises GitConflict.
+# Large files are put in with add_file and read back with write_blob, which
+# stream them between the disk and Git without holding them in memory.
+#
 # If you checkout the 'mydata' branch now, you'll see the file 'git.c' in the
 # directory 'foo/bar'.  Running 'git log' will show the change you made.
 
 import re
 import os
+import time
+import random
+import hashlib
+import threading
 
 try:
     from cStringIO import StringIO
 except:
     from StringIO import StringIO
 
+from collections import OrderedDict
 from subprocess import Popen, PIPE
+from tempfile import mkstemp
 from string import split, join
 
 ######################################################################
 
 verbose = False
 
+# Every call made to Git is reported to each function in hooks, as
+#
+#   hook(cmd, args, seconds, bytes_in, bytes_out, status)
+#
+# giving the subcommand and its arguments, the wall time taken, the bytes
+# written to the command and read back from it, and its exit status.  For
+# the `cat-file --batch' reader, which stays running, each exchange with it
+# is reported as a call of its own.
+hooks = []
+
+# Blobs larger than this many bytes are streamed by add_file and
+# write_blob, rather than held in memory by Git.
+stream_config = { 'core.bigFileThreshold': 1024 * 1024 }
+
+def report_call(cmd, args, seconds, bytes_in, bytes_out, status):
+    for hook in hooks:
+        hook(cmd, args, seconds, bytes_in, bytes_out, status)
+
 ######################################################################
 
 # Utility function for calling out to Git (this script does not try to
@@ -71,6 +109,43 @@ class GitError(Exception):
         else:
             return "Git command failed: git %s %s" % (self.cmd, self.args)
 
+class GitConflict(GitError):
+    """Raised by commit when a path it would write was also changed by a
+    commit made to the branch since the shelf last read it."""
+    def __init__(self, branch, paths):
+        self.paths = paths
+        GitError.__init__(self, 'commit', [branch], {},
+                          'changed on both sides: %s' % join(paths, ', '))
+
+def git_environ(kwargs):
+    environ = None
+    if kwargs.has_key('repository'):
+        environ = os.environ.copy()
+        environ['GIT_DIR'] = kwargs['repository']
+
+        git_dir = environ['GIT_DIR']
+        if not os.path.isdir(git_dir):
+            proc = Popen(('git', 'init'), env = environ,
+                         stdout = PIPE, stderr = PIPE)
+            if proc.wait() != 0:
+                raise GitError('init', [], {}, proc.stderr.read())
+
+    if 'worktree' in kwargs:
+        if environ is None:
+            environ = os.environ.copy()
+        environ['GIT_WORK_TREE'] = kwargs['worktree']
+        work_tree = environ['GIT_WORK_TREE']
+        if not os.path.isdir(work_tree):
+            os.makedirs(work_tree)
+
+    if 'config' in kwargs:
+        if environ is None:
+            environ = os.environ.copy()
+        environ['GIT_CONFIG_PARAMETERS'] = \
+            join(["'%s=%s'" % item for item in kwargs['config'].items()], ' ')
+
+    return environ
+
 def git(cmd, *args, **kwargs):
     restart = True
     while restart:
@@ -85,26 +160,9 @@ def git(cmd, *args, **kwargs):
                 print kwargs['input'],
                 print "EOF"
 
-        environ = None
-        if kwargs.has_key('repository'):
-            environ = os.environ.copy()
-            environ['GIT_DIR'] = kwargs['repository']
-
-            git_dir = environ['GIT_DIR']
-            if not os.path.isdir(git_dir):
-                proc = Popen(('git', 'init'), env = environ,
-                             stdout = PIPE, stderr = PIPE)
-                if proc.wait() != 0:
-                    raise GitError('init', [], {}, proc.stderr.read())
-
-        if 'worktree' in kwargs:
-            if environ is None:
-                environ = os.environ.copy()
-            environ['GIT_WORK_TREE'] = kwargs['worktree']
-            work_tree = environ['GIT_WORK_TREE']
-            if not os.path.isdir(work_tree):
-                os.makedirs(work_tree)
+        environ = git_environ(kwargs)
 
+        start = time.time()
         proc = Popen(('git', cmd) + args, env = environ,
                      stdin  = stdin_mode,
                      stdout = PIPE,
@@ -118,6 +176,9 @@ def git(cmd, *args, **kwargs):
         out, err = proc.communicate(input) 
 
         returncode = proc.returncode
+        if hooks:
+            report_call(cmd, args, time.time() - start, len(input),
+                        len(out), returncode)
         restart = False
         ignore_errors = 'ignore_errors' in kwargs and kwargs['ignore_errors']
         if returncode != 0:
@@ -134,9 +195,252 @@ def git(cmd, *args, **kwargs):
             return out[:-1]
 
 
-class gitbook:
+def git_pipe(cmd, *args, **kwargs):
+    """Start a Git command with all its standard streams connected to pipes,
+    for commands which read or write a stream of data while they run."""
+    if verbose:
+        print "Command: git %s %s" % (cmd, join(args, ' '))
+    return Popen(('git', cmd) + args, env = git_environ(kwargs),
+                 stdin  = PIPE,
+                 stdout = PIPE,
+                 stderr = PIPE)
+
+
+class gitbatch:
+    """Keeps a single `git cat-file --batch' process open for reading
+    objects, so that reading many blobs does not start a new Git process for
+    each one.  Requests for several objects are pipelined: they are all
+    written before any of the replies is read."""
+    def __init__(self, repository = None):
+        self.repository = repository
+        self.proc       = None
+
+    def start(self):
+        if self.proc is not None:
+            return
+        kwargs = {}
+        if self.repository:
+            kwargs['repository'] = self.repository
+        self.proc = git_pipe('cat-file', '--batch', **kwargs)
+
+    def write_requests(self, names):
+        try:
+            for name in names:
+                self.proc.stdin.write(name + '\n')
+            self.proc.stdin.flush()
+        except IOError:
+            pass                # the reader reports the failure
+
+    def read_object(self, name):
+        header = self.proc.stdout.readline()
+        if not header:
+            raise GitError('cat-file', ('--batch', name), {},
+                           self.proc.stderr.read())
+        fields = split(header)
+        if len(fields) != 3:
+            raise KeyError(name)
+        size = int(fields[2])
+        data = self.proc.stdout.read(size)
+        self.proc.stdout.read(1)        # the newline following the object
+        return (fields[0], fields[1], data)
+
+    def get(self, name):
+        """Return a (name, type, data) tuple for the given object."""
+        return self.get_many([name])[0]
+
+    def get_many(self, names):
+        """Return a list of (name, type, data) tuples, one for each object
+        named."""
+        self.start()
+        if len(names) == 1:
+            self.write_requests(names)
+            writer = None
+        else:
+            # Write from a separate thread, so that neither side blocks on a
+            # full pipe while the other one is waiting.
+            writer = threading.Thread(target = self.write_requests,
+                                      args = (names,))
+            writer.start()
+
+        start   = time.time()
+        objects = []
+        try:
+            for name in names:
+                objects.append(self.read_object(name))
+        except:
+            # The replies still in the pipe can no longer be matched up with
+            # their requests, so start afresh next time.
+            self.proc.stdout.close()
+            if writer:
+                writer.join()
+            self.close()
+            if hooks:
+                self.report(names, objects, start, 1)
+            raise
+
+        if writer:
+            writer.join()
+        if hooks:
+            self.report(names, objects, start, 0)
+        return objects
+
+    def report(self, names, objects, start, status):
+        bytes_in  = 0
+        for name in names:
+            bytes_in += len(name) + 1
+        bytes_out = 0
+        for (name, kind, data) in objects:
+            bytes_out += len(data)
+        report_call('cat-file', ('--batch',), time.time() - start,
+                    bytes_in, bytes_out, status)
+
+    def close(self):
+        if self.proc is None:
+            return
+        try:
+            self.proc.stdin.close()
+        except IOError:
+            pass
+        self.proc.stdout.close()
+        self.proc.stderr.close()
+        self.proc.wait()
+        self.proc = None
+
+
+class gitcache:
+    """Keeps track of the books whose data has been read, the most recently
+    used last, and drops the data of the least recently used ones once there
+    are more than max_entries of them, or they hold more than max_bytes of
+    blob data between them.  The dropped data is read again from Git when it
+    is next asked for.  Only clean books are kept track of: the data of a
+    dirty book is the only copy there is.
+
+    Without either limit no book is kept track of, and nothing is dropped,
+    but the hits and misses are still counted."""
+    def __init__(self, max_entries = None, max_bytes = None):
+        self.max_entries = max_entries
+        self.max_bytes   = max_bytes
+        self.books       = OrderedDict()
+        self.size        = 0
+        self.hits        = 0
+        self.misses      = 0
+        self.evictions   = 0
+
+    def bounded(self):
+        return self.max_entries is not None or self.max_bytes is not None
+
+    def clear(self):
+        self.books.clear()
+        self.size = 0
+
+    def discard(self, book):
+        size = self.books.pop(book, None)
+        if size is not None:
+            self.size -= size
+
+    def hit(self, book):
+        self.hits += 1
+        size = self.books.pop(book, None)
+        if size is not None:
+            self.books[book] = size     # move it to the end
+
+    def loaded(self, book, size):
+        """Keep track of a book whose data was just read from Git."""
+        self.misses += 1
+        self.add(book, size)
+
+    def add(self, book, size):
+        """Keep track of a clean book holding size bytes of blob data."""
+        if not self.bounded():
+            return
+        self.discard(book)
+        self.books[book] = size
+        self.size += size
+        self.evict()
+
+    def evict(self):
+        while self.books and \
+              ((self.max_entries is not None and
+                len(self.books) > self.max_entries) or
+               (self.max_bytes is not None and self.size > self.max_bytes)):
+            (book, size) = self.books.popitem(last = False)
+            self.size -= size
+            if not book.dirty and book.name:
+                book.data = None
+                self.evictions += 1
+
+    def stats(self):
+        return { 'hits':      self.hits,
+                 'misses':    self.misses,
+                 'evictions': self.evictions,
+                 'entries':   len(self.books),
+                 'bytes':     self.size }
+
+
+class counted_stream:
+    """Passes writes on to a stream, counting the bytes written."""
+    def __init__(self, stream):
+        self.stream = stream
+        self.count  = 0
+
+    def write(self, data):
+        self.count += len(data)
+        self.stream.write(data)
+
+
+def hash_object(kind, data, object_format = 'sha1'):
+    """Compute the name Git gives to an object, without asking Git."""
+    if isinstance(data, unicode):
+        data = data.encode('utf-8')
+    digest = hashlib.new(object_format)
+    digest.update('%s %d\0' % (kind, len(data)))
+    digest.update(data)
+    return digest.hexdigest()
+
+def intern_name(name):
+    """Intern a path component, so that a name found in many trees, such as
+    a common file name, is only held in memory once."""
+    if type(name) is str:
+        return intern(name)
+    return name
+
+def same_entry(a, b):
+    """Return True if two entries of a tree, books or trees, are known to
+    have the same contents, or are both missing."""
+    if a is None or b is None:
+        return a is b
+    if isinstance(a, gitbook):
+        name = a.name
+    else:
+        name = a.get('__root__')
+    if isinstance(b, gitbook):
+        return name is not None and name == b.name
+    return name is not None and name == b.get('__root__')
+
+def entry_kind(entry):
+    if entry is None:
+        return None
+    if isinstance(entry, gitbook):
+        return 'blob'
+    return 'tree'
+
+def import_path(path):
+    """Quote a path for use in a `git fast-import' file command."""
+    if '\n' in path or path.startswith('"'):
+        return '"%s"' % path.replace('\\', '\\\\').replace('"', '\\"') \
+                            .replace('\n', '\\n')
+    return path
+
+
+class gitbook(object):
     """Abstracts a reference to a data file within a Git repository.  It also
-    maintains knowledge of whether the object has been modified or not."""
+    maintains knowledge of whether the object has been modified or not.
+
+    A shelf holds one book for every file in its branch, so books keep their
+    attributes in slots rather than in a dictionary of their own.  Subclasses
+    should declare `__slots__ = ()' to stay as small."""
+    __slots__ = ('shelf', 'path', 'name', 'data', 'dirty')
+
     def __init__(self, shelf, path, name = None):
         self.shelf = shelf
         self.path  = path
@@ -148,16 +452,23 @@ class gitbook:
         return '<gitshelve.gitbook %s %s %s>'%(self.path, self.name, self.dirty)
 
     def get_data(self):
-        if self.data is None:
+        data = self.data
+        if data is None:
             assert self.name is not None
-            self.data = self.deserialize_data(self.shelf.get_blob(self.name))
-        return self.data
+            blob = self.shelf.get_blob(self.name)
+            data = self.data = self.deserialize_data(blob)
+            self.shelf.cache.loaded(self, len(blob))
+        elif not self.dirty:
+            self.shelf.cache.hit(self)
+        return data
         
     def set_data(self, data):
         if data != self.data:
             self.name  = None
             self.data  = data
             self.dirty = True
+            self.shelf.cache.discard(self)
+            self.shelf.mark_dirty(self.path)
 
     def serialize_data(self, data):
         return data
@@ -166,15 +477,19 @@ class gitbook:
         return data
 
     def change_comment(self):
+        """Return text describing the change to this book, which is added to
+        the message of the commit writing it, or None."""
         return None
 
     def __getstate__(self):
-        odict = self.__dict__.copy() # copy the dict since we change it
-        del odict['dirty']           # remove dirty flag
-        return odict
+        return { 'shelf': self.shelf,   # leave out the dirty flag
+                 'path':  self.path,
+                 'name':  self.name,
+                 'data':  self.data }
 
     def __setstate__(self, ndict):
-        self.__dict__.update(ndict) # update attributes
+        for key in ndict.keys():
+            setattr(self, key, ndict[key])
         self.dirty = False
 
 
@@ -186,25 +501,63 @@ class gitshelve(dict):
     This implementation uses a dictionary of gitbook objects, since we don't
     really want to use Pickling within a Git repository (it's not friendly to
     other Git users, nor does it support merging)."""
-    ls_tree_pat = re.compile('((\d{6}) (tree|blob)) ([0-9a-f]{40})\t(start|(.+))$')
-
-    head    = None
-    dirty   = False
-    objects = None
+    ls_tree_pat = re.compile('((\d{6}) (tree|blob)) ([0-9a-f]{40}(?:[0-9a-f]{24})?)\t(start|(.+))$')
+
+    head          = None
+    dirty         = False
+    dirty_paths   = None
+    objects       = None
+    reader        = None
+    object_format = None
+    importer      = None
+
+    # When another writer moves the branch while a commit is being made, the
+    # commit is made again on top of its work this many times, waiting
+    # about retry_delay seconds before the first retry, and twice as long
+    # before each one after.
+    retries       = 8
+    retry_delay   = 0.05
 
     def __init__(self, branch = 'master', repository = None,
-                 keep_history = True, book_type = gitbook):
-        self.branch       = branch
-        self.repository   = repository
-        self.keep_history = keep_history
-        self.book_type    = book_type
+                 keep_history = True, book_type = gitbook,
+                 fast_import = False, lazy = False,
+                 cache_entries = None, cache_bytes = None):
+        self.branch        = branch
+        self.repository    = repository
+        self.keep_history  = keep_history
+        self.book_type     = book_type
+        self.fast_import   = fast_import
+        self.lazy          = lazy
+        self.cache_entries = cache_entries
+        self.cache_bytes   = cache_bytes
+        self.cache         = gitcache(cache_entries, cache_bytes)
+        self.ahead         = []         # change comments of books written
         self.init_data()
         dict.__init__(self)
 
     def init_data(self):
-        self.head    = None
-        self.dirty   = False
-        self.objects = {}
+        self.head        = None
+        self.dirty       = False
+        self.dirty_paths = set()
+        self.objects     = {}
+        self.cache.clear()
+
+    def mark_dirty(self, path):
+        """Note that the book at path, or the tree, was changed or removed;
+        only the trees holding such paths are written by the next commit."""
+        self.dirty_paths.add(path)
+        self.dirty = True
+
+    def dirty_trees(self):
+        """Return the paths of all the trees which hold a changed path, down
+        from the top-level tree, whose path is the empty string."""
+        trees = set()
+        for path in self.dirty_paths:
+            trees.add('')
+            parts = split(path, '/')
+            for i in range(1, len(parts)):
+                trees.add(join(parts[:i], '/'))
+        return trees
 
     def git(self, *args, **kwargs):
         if self.repository:
@@ -213,16 +566,15 @@ class gitshelve(dict):
 
     def current_head(self):
         x = self.git('rev-parse', self.branch)
-        if len(x) != 40:
+        if len(x) not in (40, 64):
             raise ValueError("rev-parse went insane: %s"%x)
         return x
 
     def update_head(self, new_head):
-        if self.head:
-            self.git('update-ref', 'refs/heads/%s' % self.branch, new_head,
-                     self.head)
-        else:
-            self.git('update-ref', 'refs/heads/%s' % self.branch, new_head)
+        # The branch is only moved if it is still where the shelf found it;
+        # an empty old value means that it must not exist yet.
+        self.git('update-ref', 'refs/heads/%s' % self.branch, new_head,
+                 self.head or '')
         self.head = new_head
 
     def read_repository(self):
@@ -235,6 +587,14 @@ class gitshelve(dict):
         if not self.head:
             return
 
+        if self.lazy:
+            # Only the top-level tree is read now; every tree below it is
+            # represented by a dictionary holding nothing but its __root__,
+            # until something reaches into it.
+            self.objects['__root__'] = '%s^{tree}' % self.head
+            self.read_trees([(self.objects, '')])
+            return
+
         ls_tree = split(self.git('ls-tree', '-r', '-t', '-z', self.head),
                         '\0')
         for line in ls_tree:
@@ -250,78 +610,383 @@ class gitshelve(dict):
 
             parts = split(path, os.sep)
             d     = self.objects
-            for part in parts:
-                if not d.has_key(part):
-                    d[part] = {}
+            for part in parts[:-1]:
                 d = d[part]
+            entry = intern_name(parts[-1])
 
             if treep:
                 if perm == '040000' :
-                    d['__root__'] = name
+                    d[entry] = { '__root__': name }
                 else :
                     raise GitError('read_repository', [], {},
                                    'Invalid mode for %s : 040000 required, %s found' %(path, perm))
             else:
                 if perm == '100644' :
-                    d['__book__'] = self.book_type(self, path, name)
+                    d[entry] = self.book_type(self, path, name)
                 else :
                     raise GitError('read_repository', [], {},
                                    'Invalid mode for %s : 100644 required, %s found' %(path, perm))
 
+    def diff_heads(self, old_head, new_head, trees = False,
+                   old_names = False, paths = None):
+        """Return a (status, mode, name, path) tuple for every blob which
+        differs between two commits, and with trees for every tree as well.
+        The status is one of A, D, M or T, as given by `git diff-tree'.  With
+        old_names, each tuple ends with the name the entry had before, too.
+        With paths, only the entries matching one of those pathspecs are
+        compared.  Either head can also name a tree."""
+        args = ['-r', '-z', '--no-renames']
+        if trees:
+            args.append('-t')
+        args += [old_head, new_head]
+        if paths:
+            args += ['--'] + paths
+        diff = self.git('diff-tree', *args)
+
+        changes = []
+        fields  = split(diff, '\0')
+        for i in range(0, len(fields) - 1, 2):
+            (old_perm, perm, old_name, name, status) = split(fields[i][1:])
+            if old_names:
+                changes.append((status, perm, name, fields[i + 1], old_name))
+            else:
+                changes.append((status, perm, name, fields[i + 1]))
+        return changes
+
+    def empty_tree(self):
+        """Return the name of the tree with nothing in it, which Git knows
+        of without it being stored."""
+        return hash_object('tree', '', self.get_object_format())
+
+    def refresh(self):
+        """Bring the shelf up to date with its branch, after another writer
+        has moved it.  Only the entries which differ between the old and the
+        new head are replaced, so books at paths which did not change keep
+        the data already read for them.  Returns True if the head moved."""
+        try:
+            head = self.current_head()
+        except:
+            head = None
+
+        if head == self.head:
+            return False
+        if not self.head or not head:
+            self.read_repository()
+            return True
+
+        try:
+            changes = self.diff_heads(self.head, head, trees = True)
+        except GitError:
+            self.read_repository()
+            return True
+
+        for (status, perm, name, path) in changes:
+            parts = split(path, '/')
+
+            # Find the tree holding the entry.  If that tree, or any tree
+            # above it, was never read, then nothing below it needs to
+            # change: its new __root__ is set by the entry for it.
+            d = self.objects
+            for part in parts[:-1]:
+                if not d.has_key(part) or not isinstance(d[part], dict) or \
+                   self.unread_tree(d[part]):
+                    d = None
+                    break
+                d = d[part]
+            if d is None:
+                continue
+
+            entry = intern_name(parts[-1])
+            if d.has_key(entry) and isinstance(d[entry], gitbook) and \
+               d[entry].dirty:
+                continue        # changed here too; the commit will tell
+
+            if status == 'D':
+                if d.has_key(entry):
+                    del d[entry]
+            elif perm == '040000':
+                if d.has_key(entry) and isinstance(d[entry], dict) \
+                   and not self.unread_tree(d[entry]):
+                    d[entry]['__root__'] = name
+                else:
+                    d[entry] = { '__root__': name }
+            elif perm == '100644':
+                d[entry] = self.book_type(self, path, name)
+            else:
+                raise GitError('refresh', [], {},
+                               'Invalid mode for %s : %s found' %
+                               (path, perm))
+
+        # The top-level tree has no entry of its own in the diff.
+        if self.objects.has_key('__root__'):
+            del self.objects['__root__']
+
+        self.head = head
+        return True
+
+    def read_trees(self, trees, recursive = False):
+        """Fill in the entries of the given (objects, path) pairs, each of
+        which holds only the __root__ of a tree not read yet.  All the trees
+        at one level are requested from Git together, and with recursive
+        each following level is read the same way."""
+        while trees:
+            found = self.get_reader().get_many([objects['__root__']
+                                                for (objects, path) in trees])
+            subtrees = []
+            for i in range(len(trees)):
+                (objects, path) = trees[i]
+                (name, kind, data) = found[i]
+                if kind != 'tree':
+                    raise GitError('read_trees', [], {},
+                                   '%s is a %s, not a tree' % (name, kind))
+                objects['__root__'] = name
+
+                size = len(name) / 2
+                pos  = 0
+                while pos < len(data):
+                    space = data.index(' ', pos)
+                    nul   = data.index('\0', space)
+                    perm  = data[pos:space]
+                    entry = intern_name(data[space + 1:nul])
+                    pos   = nul + 1 + size
+                    sha   = data[nul + 1:pos].encode('hex')
+
+                    if path:
+                        subpath = '%s/%s' % (path, entry)
+                    else:
+                        subpath = entry
+
+                    if perm == '40000':
+                        objects[entry] = { '__root__': sha }
+                        if recursive:
+                            subtrees.append((objects[entry], subpath))
+                    elif perm == '100644':
+                        objects[entry] = self.book_type(self, subpath, sha)
+                    else:
+                        raise GitError('read_trees', [], {},
+                                       'Invalid mode for %s : %s found' %
+                                       (subpath, perm))
+            trees = subtrees
+
+    def unread_tree(self, objects):
+        return isinstance(objects, dict) and \
+               len(objects) == 1 and objects.has_key('__root__')
+
+    def load_tree(self, objects, path):
+        """Make sure the entries of the given tree have been read."""
+        if self.unread_tree(objects):
+            self.read_trees([(objects, path)])
+        return objects
+
+    def unload_tree(self, path):
+        """Forget everything read below the tree at path, which is read
+        again from Git when next reached.  This lets a long scan keep only
+        the part of the shelf it is in.  A tree holding changes not yet
+        committed is kept, and False returned."""
+        (d, name) = self.get_parent(path)
+        tree = d[name]
+        if not isinstance(tree, dict) or not tree.has_key('__root__'):
+            return False
+        for dirty in self.dirty_paths:
+            if dirty == path or dirty.startswith(path + '/'):
+                return False
+        d[name] = { '__root__': tree['__root__'] }
+        return True
+
+    def load_children(self, objects, path):
+        """Read every tree below the given one, for callers which are going
+        to visit all of them anyway."""
+        unread = []
+        for key in objects.keys():
+            if key == '__root__': continue
+            if self.unread_tree(objects[key]):
+                if path:
+                    unread.append((objects[key], '%s/%s' % (path, key)))
+                else:
+                    unread.append((objects[key], key))
+        if unread:
+            self.read_trees(unread, recursive = True)
+
     def open(cls, branch = 'master', repository = None,
-             keep_history = True, book_type = gitbook):
-        shelf = gitshelve(branch, repository, keep_history, book_type)
+             keep_history = True, book_type = gitbook, fast_import = False,
+             lazy = False, cache_entries = None, cache_bytes = None):
+        shelf = gitshelve(branch, repository, keep_history, book_type,
+                          fast_import, lazy, cache_entries, cache_bytes)
         shelf.read_repository()
         return shelf
 
     open = classmethod(open)
 
+    def get_reader(self):
+        if self.reader is None:
+            self.reader = gitbatch(self.repository)
+        return self.reader
+
     def get_blob(self, name):
-        return self.git('cat-file', 'blob', name, keep_newline = True)
+        (name, kind, data) = self.get_reader().get(name)
+        if kind != 'blob':
+            raise GitError('cat-file', ('--batch', name), {},
+                           '%s is a %s, not a blob' % (name, kind))
+        return data
+
+    def get_many(self, paths):
+        """Return the data stored at each of the given paths.  All the blobs
+        which have not been read yet are requested from Git at once."""
+        return self.read_books([self.get_book(path) for path in paths])
+
+    def read_books(self, books):
+        """Return the data of each of the given books, reading all those not
+        read yet from Git at once."""
+        data   = [book.data for book in books]
+        unread = [i for i in range(len(books)) if data[i] is None]
+        for i in range(len(books)):
+            if data[i] is not None and not books[i].dirty:
+                self.cache.hit(books[i])
+        if unread:
+            blobs = self.get_reader().get_many([books[i].name
+                                                for i in unread])
+            for i, blob in zip(unread, blobs):
+                book = books[i]
+                book.data = data[i] = book.deserialize_data(blob[2])
+                self.cache.loaded(book, len(blob[2]))
+
+        return data
+
+    def get_object_format(self):
+        """Return the name of the hash function used by the repository,
+        which is only asked of Git once per shelf."""
+        if self.object_format is None:
+            object_format = self.git('rev-parse', '--show-object-format',
+                                     ignore_errors = True)
+            if object_format not in ('sha1', 'sha256'):
+                object_format = 'sha1'
+            self.object_format = object_format
+        return self.object_format
 
     def hash_blob(self, data):
-        return self.git('hash-object', '--stdin', input = data)
+        return hash_object('blob', data, self.get_object_format())
 
     def make_blob(self, data):
         return self.git('hash-object', '-w', '--stdin', input = data)
 
-    def make_tree(self, objects, comment_accumulator = None):
+    def add_file(self, path, filename):
+        """Put the contents of the file named filename into the shelf at
+        path, and return the name of its blob.  Git reads the file itself,
+        so however large it is, it is never held in memory here; nor is it
+        read back unless asked for."""
+        # Below this size Git reads the whole file into memory to compress
+        # it; above it, the file is streamed into a pack of its own.
+        name = self.git('hash-object', '-w', '--no-filters', '--',
+                        os.path.abspath(filename), config = stream_config)
+        (d, entry) = self.get_parent(path, make_dirs = True)
+        d[entry] = self.book_type(self, path, name)
+        self.mark_dirty(path)
+        return name
+
+    def write_book(self, path):
+        """Write the data of the changed book at path to Git now, rather than
+        with the next commit, and let go of it, so that a commit can write
+        any number of books without holding all of them in memory.  The book
+        stays changed as far as the commit is concerned.  With fast_import,
+        the blob goes to the process which makes the commit, so it cannot be
+        read back until then.  Returns the name of the blob."""
+        book = self.get_book(path)
+        if not book.dirty:
+            return book.name
+
+        comment = book.change_comment()
+        if comment:
+            self.ahead.append(comment)
+        data = book.serialize_data(book.data)
+        if self.fast_import:
+            stream = self.start_import()[1]
+            stream.write('blob\ndata %d\n%s\n' % (len(data), data))
+            book.name = self.hash_blob(data)
+        else:
+            book.name = self.make_blob(data)
+        book.data  = None
+        book.dirty = False
+        return book.name
+
+    def write_blob(self, name, fd, chunk_size = 65536):
+        """Copy the blob with the given name to the file fd, chunk_size bytes
+        at a time, and return its size."""
+        kwargs = { 'config': stream_config }
+        if self.repository:
+            kwargs['repository'] = self.repository
+        start = time.time()
+        proc  = git_pipe('cat-file', 'blob', name, **kwargs)
+        proc.stdin.close()
+        size  = 0
+        while True:
+            chunk = proc.stdout.read(chunk_size)
+            if not chunk:
+                break
+            fd.write(chunk)
+            size += len(chunk)
+        err = proc.stderr.read()
+        proc.wait()
+        if hooks:
+            report_call('cat-file', ('blob', name), time.time() - start,
+                        0, size, proc.returncode)
+        if proc.returncode != 0:
+            raise GitError('cat-file', ('blob', name), {}, err)
+        return size
+
+    def make_tree(self, objects, comment_accumulator = None, path = '',
+                  dirty = None):
+        """Write the tree for objects, and any tree below it which holds a
+        changed path.  Unchanged subtrees are given by their existing hash,
+        without being visited."""
+        if dirty is None:
+            dirty = self.dirty_trees()
+
         buf = StringIO()
 
         root = None
-        if objects.has_key('__root__'):
+        if objects.has_key('__root__') and path not in dirty:
             root = objects['__root__']
 
-        for path in objects.keys():
-            if path == '__root__': continue
+        for key in objects.keys():
+            if key == '__root__': continue
 
-            obj = objects[path]
-            assert isinstance(obj, dict)
+            obj = objects[key]
 
-            if len(obj.keys()) == 1 and obj.has_key('__book__'):
-                book = obj['__book__']
+            if isinstance(obj, gitbook):
+                book = obj
                 if book.dirty:
                     if comment_accumulator:
                         comment = book.change_comment()
                         if comment:
                             comment_accumulator.write(comment)
 
-                    book.name  = self.make_blob(book.serialize_data(book.data))
+                    blob = book.serialize_data(book.data)
+                    book.name  = self.make_blob(blob)
                     book.dirty = False
+                    self.cache.add(book, len(blob))
                     root = None
 
-                buf.write("100644 blob %s\t%s\0" % (book.name, path))
+                buf.write("100644 blob %s\t%s\0" % (book.name, key))
 
             else:
+                if path:
+                    subpath = '%s/%s' % (path, key)
+                else:
+                    subpath = key
+
                 tree_root = None
                 if obj.has_key('__root__'):
                     tree_root = obj['__root__']
 
-                tree_name = self.make_tree(obj, comment_accumulator)
+                if tree_root and subpath not in dirty:
+                    tree_name = tree_root
+                else:
+                    tree_name = self.make_tree(obj, comment_accumulator,
+                                               subpath, dirty)
                 if tree_name != tree_root:
                     root = None
 
-                buf.write("040000 tree %s\t%s\0" % (tree_name, path))
+                buf.write("040000 tree %s\t%s\0" % (tree_name, key))
 
         if root is None:
             name = self.git('mktree', '-z', input = buf.getvalue())
@@ -330,38 +995,423 @@ class gitshelve(dict):
         else:
             return root
 
-    def make_commit(self, tree_name, comment):
+    def make_commit(self, tree_name, comment, parents = None):
         if not comment: comment = ""
-        if self.head and self.keep_history:
-            name = self.git('commit-tree', tree_name, '-p', self.head,
-                            input = comment)
-        else:
-            name = self.git('commit-tree', tree_name, input = comment)
+        if parents is None:
+            parents = []
+            if self.head and self.keep_history:
+                parents = [self.head]
+        args = []
+        for parent in parents:
+            args.extend(['-p', parent])
+        name = self.git('commit-tree', tree_name, input = comment, *args)
 
         self.update_head(name)
         return name
 
+    def import_tree(self, stream, objects, path, books, trees,
+                    comment_accumulator = None, dirty = None):
+        """Write a blob command to the fast-import stream for every dirty
+        book below objects, and return a tuple of whether the tree changed
+        and the file commands which recreate it.  A tree which did not change
+        is given by its existing hash, instead of by its contents, and trees
+        holding no changed path are not visited at all."""
+        if dirty is None:
+            dirty = self.dirty_trees()
+
+        changed  = not objects.has_key('__root__') or path in dirty
+        commands = []
+
+        for key in objects.keys():
+            if key == '__root__': continue
+
+            obj = objects[key]
+
+            if path:
+                subpath = '%s/%s' % (path, key)
+            else:
+                subpath = key
+
+            if isinstance(obj, gitbook):
+                book = obj
+                if book.dirty:
+                    if comment_accumulator:
+                        comment = book.change_comment()
+                        if comment:
+                            comment_accumulator.write(comment)
+
+                    data = book.serialize_data(book.data)
+                    books.append((book, len(data)))
+                    stream.write('blob\nmark :%d\ndata %d\n%s\n' %
+                                     (len(books), len(data), data))
+                    commands.append('M 100644 :%d %s\n' %
+                                    (len(books), import_path(subpath)))
+                    changed = True
+                else:
+                    commands.append('M 100644 %s %s\n' %
+                                    (book.name, import_path(subpath)))
+            elif obj.has_key('__root__') and subpath not in dirty:
+                commands.append('M 040000 %s %s\n' % (obj['__root__'],
+                                                       import_path(subpath)))
+            else:
+                (tree_changed, tree_commands) = \
+                    self.import_tree(stream, obj, subpath, books, trees,
+                                     comment_accumulator, dirty)
+                if tree_changed:
+                    changed = True
+                commands.extend(tree_commands)
+
+        if changed:
+            trees.append((path, objects))
+        elif path:
+            commands = ['M 040000 %s %s\n' % (objects['__root__'],
+                                               import_path(path))]
+        return (changed, commands)
+
+    def start_import(self):
+        """Start the `git fast-import' process which the next commit is made
+        through, unless it was started already, and return a tuple of it,
+        the stream writing to it, its arguments, the file it exports its
+        marks to and the time it started."""
+        if self.importer is None:
+            fd, marks_file = mkstemp()
+            os.close(fd)
+            args = ['--quiet', '--export-marks=%s' % marks_file]
+            if not self.keep_history:
+                args.append('--force')
+            kwargs = {}
+            if self.repository:
+                kwargs['repository'] = self.repository
+            start = time.time()
+            proc  = git_pipe('fast-import', *args, **kwargs)
+            self.importer = (proc, counted_stream(proc.stdin), args,
+                             marks_file, start)
+        return self.importer
+
+    def import_commit(self, comment = None):
+        """Write all the dirty books, the trees holding them and the commit
+        through a single `git fast-import' process, which stores them in one
+        pack and then moves the branch."""
+        accumulator = StringIO()
+
+        committer = self.git('var', 'GIT_COMMITTER_IDENT')
+        author    = self.git('var', 'GIT_AUTHOR_IDENT')
+
+        (proc, stream, args, marks_file, start) = self.start_import()
+        self.importer = None
+        try:
+            books = []
+            trees = []
+            try:
+                (changed, commands) = \
+                    self.import_tree(stream, self.objects, '', books, trees,
+                                     accumulator)
+                comment = self.commit_message(comment, accumulator)
+
+                commit_mark = len(books) + 1
+                stream.write('commit refs/heads/%s\n' % self.branch)
+                stream.write('mark :%d\n' % commit_mark)
+                stream.write('author %s\n' % author)
+                stream.write('committer %s\n' % committer)
+                stream.write('data %d\n%s\n' % (len(comment), comment))
+                if self.head and self.keep_history:
+                    stream.write('from %s\n' % self.head)
+                stream.write('deleteall\n')
+                for command in commands:
+                    stream.write(command)
+                stream.write('\ndone\n')
+            except IOError:
+                pass            # fast-import died; its stderr says why
+
+            out, err = proc.communicate()
+            if hooks:
+                report_call('fast-import', tuple(args), time.time() - start,
+                            stream.count, len(out), proc.returncode)
+            if proc.returncode != 0:
+                raise GitError('fast-import', args, {}, err)
+
+            marks = {}
+            fd = file(marks_file)
+            try:
+                for line in fd:
+                    (mark, name) = split(line)
+                    marks[int(mark[1:])] = name
+            finally:
+                fd.close()
+        finally:
+            os.unlink(marks_file)
+
+        for i in range(len(books)):
+            (book, size) = books[i]
+            book.name  = marks[i + 1]
+            book.dirty = False
+            self.cache.add(book, size)
+
+        name = marks[commit_mark]
+        self.head = name
+
+        # Learn the hashes of the trees fast-import has written, so that they
+        # can be reused by later commits.
+        requests = []
+        for (path, objects) in trees:
+            if path:
+                requests.append('%s:%s' % (name, path))
+            else:
+                requests.append('%s^{tree}' % name)
+        found = self.get_reader().get_many(requests)
+        for i in range(len(trees)):
+            trees[i][1]['__root__'] = found[i][0]
+
+        return name
+
     def commit(self, comment = None):
         if not self.dirty:
             return self.head
 
-        accumulator = None
+        attempt = 0
+        while True:
+            base = self.head
+            try:
+                if self.fast_import:
+                    name = self.import_commit(comment)
+                else:
+                    accumulator = StringIO()
+
+                    # Walk the objects now, creating and nesting trees until
+                    # we end up with a top-level tree.  We then create a
+                    # commit out of this tree.  Its books are written now,
+                    # so a retry has the message already.
+                    tree    = self.make_tree(self.objects, accumulator)
+                    comment = self.commit_message(comment, accumulator)
+                    self.ahead = []
+                    name    = self.make_commit(tree, comment)
+                break
+            except GitError:
+                if attempt == self.retries or not self.head_moved(base):
+                    raise
+            time.sleep(self.retry_delay * (2 ** attempt) *
+                       random.uniform(0.5, 1.5))
+            attempt += 1
+            self.rebase(base)
+
+        self.dirty       = False
+        self.dirty_paths = set()
+        self.ahead       = []
+        return name
+
+    def commit_message(self, comment, accumulator):
+        """Return the message of a commit: the comment given, followed by
+        what the books written said of their changes."""
+        changes = "".join(self.ahead) + accumulator.getvalue()
         if comment is None:
-            accumulator = StringIO()
-        
-        # Walk the objects now, creating and nesting trees until we end up
-        # with a top-level tree.  We then create a commit out of this tree.
-        tree = self.make_tree(self.objects, accumulator)
-        if accumulator:
-            comment = accumulator.getvalue()
-        name = self.make_commit(tree, comment)
+            return changes
+        if changes:
+            return "%s\n\n%s" % (comment.rstrip('\n'), changes)
+        return comment
 
-        self.dirty = False
-        return name
+    def head_moved(self, base):
+        """Return True if the branch is no longer at base."""
+        try:
+            return self.current_head() != base
+        except GitError:
+            return False
+
+    def dirty_changes(self):
+        """Return a (path, book) pair for every changed path, where book is
+        None if nothing is there any longer."""
+        changes = []
+        for path in self.dirty_paths:
+            try:
+                book = self.get_tree(path)
+            except KeyError:
+                book = None
+            if not isinstance(book, gitbook):
+                book = None
+            changes.append((path, book))
+        changes.sort()
+        return changes
+
+    def rebase(self, base):
+        """Move the shelf's changes, which were made on top of base, on top
+        of the commit the branch is at now.  The books changed there are
+        read as by refresh, and then the paths changed here are removed or
+        written again.  If the same path, or a tree holding it, was changed
+        on both sides, GitConflict is raised and the shelf is left as it
+        was."""
+        changes = self.dirty_changes()
+        head    = self.current_head()
+
+        ours = set(self.dirty_paths)
+        if base:
+            theirs = set([path for (status, perm, name, path)
+                          in self.diff_heads(base, head)])
+        else:
+            theirs = set(split(self.git('ls-tree', '-r', '--name-only',
+                                        '-z', head), '\0')[:-1])
+
+        # The paths changed here are reported: both those changed there as
+        # well, and those which hold, or are held by, a path changed there.
+        conflicts = set()
+        for path in theirs:
+            parts = split(path, '/')
+            for i in range(1, len(parts) + 1):
+                if join(parts[:i], '/') in ours:
+                    conflicts.add(join(parts[:i], '/'))
+        for path in ours:
+            parts = split(path, '/')
+            for i in range(1, len(parts)):
+                if join(parts[:i], '/') in theirs:
+                    conflicts.add(path)
+        if conflicts:
+            raise GitConflict(self.branch, sorted(conflicts))
+
+        self.refresh()
+        for (path, book) in changes:
+            if book is None:
+                try:
+                    del self[path]
+                except KeyError:
+                    pass
+        for (path, book) in changes:
+            if book is not None:
+                (d, name) = self.get_parent(path, make_dirs = True)
+                d[name] = book
+                self.mark_dirty(path)
 
     def sync(self):
         self.commit()
 
+    def merge(self, ref, resolve = None, comment = None):
+        """Merge the commit named by ref into the shelf's branch, and return
+        the commit the branch is at afterwards.  Any changes in the shelf
+        are committed first.
+
+        The trees of the merge base, of the branch and of ref are compared
+        level by level, all the trees of one level being read together, and
+        a subtree with the same hash on two sides is not looked into.  Only
+        books changed on both sides are read; each is passed, as the data of
+        the three sides, to
+
+          resolve(path, base, ours, theirs)
+
+        with None for a side where it does not exist, which returns the data
+        to write, or None to remove it.  If there is no resolve, or it raises
+        GitConflict, or a book on one side is a tree on the other, the shelf
+        is left as it was and GitConflict is raised for all such paths.  The
+        result is written as one commit with both parents, unless the branch
+        only has to be moved forward to ref."""
+        self.commit()
+
+        theirs = self.git('rev-parse', '%s^{commit}' % ref)
+        base   = None
+        if self.head:
+            try:
+                base = self.git('merge-base', self.head, theirs)
+            except GitError:
+                pass            # no history in common
+            if base == theirs:
+                return self.head
+
+        if not self.head or base == self.head:
+            self.git('update-ref', 'refs/heads/%s' % self.branch, theirs,
+                     self.head or '')
+            self.refresh()
+            return self.head
+
+        if base:
+            base_tree = { '__root__': '%s^{tree}' % base }
+        else:
+            base_tree = {}
+        their_tree = { '__root__': '%s^{tree}' % theirs }
+
+        changes   = []          # (path, entry of theirs to take, or None)
+        both      = []          # (path, base, ours, theirs) books
+        conflicts = []
+        level     = [('', base_tree, self.objects, their_tree)]
+        while level:
+            unread = []
+            for (path, b, o, t) in level:
+                for tree in (b, o, t):
+                    if self.unread_tree(tree):
+                        unread.append((tree, path))
+            self.read_trees(unread)
+
+            subtrees = []
+            for (path, b, o, t) in level:
+                keys = set(b.keys()) | set(o.keys()) | set(t.keys())
+                keys.discard('__root__')
+                for key in sorted(keys):
+                    if path:
+                        subpath = '%s/%s' % (path, key)
+                    else:
+                        subpath = key
+                    (bo, oo, to) = (b.get(key), o.get(key), t.get(key))
+
+                    if same_entry(oo, to) or same_entry(bo, to):
+                        continue
+                    if same_entry(bo, oo):
+                        changes.append((subpath, to))
+                        continue
+
+                    kinds = set([entry_kind(bo), entry_kind(oo),
+                                 entry_kind(to)])
+                    kinds.discard(None)
+                    if kinds == set(['tree']):
+                        subtrees.append((subpath, bo or {}, oo or {},
+                                         to or {}))
+                    elif kinds == set(['blob']):
+                        both.append((subpath, bo, oo, to))
+                    else:
+                        conflicts.append(subpath)
+            level = subtrees
+
+        books = []
+        for (path, bo, oo, to) in both:
+            books.extend([book for book in (bo, oo, to) if book is not None])
+        self.read_books(books)
+
+        merged = []
+        for (path, bo, oo, to) in both:
+            data = [book and book.data for book in (bo, oo, to)]
+            if resolve is None:
+                conflicts.append(path)
+                continue
+            try:
+                merged.append((path, oo, resolve(path, *data)))
+            except GitConflict:
+                conflicts.append(path)
+
+        if conflicts:
+            raise GitConflict(self.branch, sorted(conflicts))
+
+        for (path, entry) in changes:
+            if entry is None:
+                del self[path]
+            else:
+                (d, name) = self.get_parent(path, make_dirs = True)
+                d[name] = entry
+                self.mark_dirty(path)
+        for (path, ours, data) in merged:
+            if data is not None:
+                # resolve may have changed the data of ours in place, and
+                # returned it; it is written through a new book all the same.
+                if ours is not None:
+                    self.cache.discard(ours)
+                (d, name) = self.get_parent(path, make_dirs = True)
+                d[name] = self.book_type(self, path)
+                d[name].set_data(data)
+            elif ours is not None:
+                del self[path]
+
+        if comment is None:
+            comment = "Merge %s\n" % ref
+        tree = self.make_tree(self.objects)
+        name = self.make_commit(tree, comment, [self.head, theirs])
+
+        self.dirty       = False
+        self.dirty_paths = set()
+        return name
+
     def get_parent_ids(self):
         r = self.git('rev-list', '--parents', '--max-count=1', self.branch)
         return r.split()[1:]
@@ -369,11 +1419,15 @@ class gitshelve(dict):
     def close(self):
         if self.dirty:
             self.sync()
+        if self.reader:
+            self.reader.close()
+            self.reader = None
         del self.objects        # free it up right away
 
     def dump_objects(self, fd, indent = 0, objects = None):
         if objects is None:
             objects = self.objects
+            self.load_children(objects, '')
 
         if objects.has_key('__root__') and indent == 0:
             fd.write('%stree %s\n' % (" " * indent, objects['__root__']))
@@ -383,10 +1437,9 @@ class gitshelve(dict):
         keys.sort()
         for key in keys:
             if key == '__root__': continue
-            assert isinstance(objects[key], dict)
 
-            if objects[key].has_key('__book__'):
-                book = objects[key]['__book__']
+            if isinstance(objects[key], gitbook):
+                book = objects[key]
                 if book.name:
                     kind = 'blob ' + book.name
                 else:
@@ -402,60 +1455,81 @@ class gitshelve(dict):
             if kind[:4] == 'tree':
                 self.dump_objects(fd, indent + 2, objects[key])
 
-    def get_tree(self, path, make_dirs = False):
+    def get_parent(self, path, make_dirs = False):
+        """Return the tree holding the entry at path, and the name of the
+        entry within it.  With make_dirs, missing trees along the way are
+        created, and a book standing in the way is replaced by a tree."""
         parts = split(path, os.sep)
         d     = self.objects
-        for part in parts:
-            if make_dirs and not d.has_key(part):
-                d[part] = {}
+        for i in range(len(parts) - 1):
+            part = parts[i]
+            if make_dirs and (not d.has_key(part) or
+                              not isinstance(d[part], dict)):
+                d[intern_name(part)] = {}
             d = d[part]
-        return d
+            if not isinstance(d, dict):
+                raise KeyError(path)
+            self.load_tree(d, join(parts[:i + 1], '/'))
+        return (d, intern_name(parts[-1]))
+
+    def get_tree(self, path, make_dirs = False):
+        """Return the tree at path, or the book if path names a file."""
+        (d, name) = self.get_parent(path, make_dirs)
+        if make_dirs and not d.has_key(name):
+            d[name] = {}
+        return self.load_tree(d[name], path)
+
+    def get_book(self, path):
+        try:
+            book = self.get_tree(path)
+        except KeyError:
+            raise KeyError(path)
+        if not isinstance(book, gitbook):
+            raise KeyError(path)
+        return book
 
     def get(self, key):
-        path = '%s/%s' % (key[:2], key[2:])
-        d = None
         try:
-            d = self.get_tree(path)
+            return self.get_book('%s/%s' % (key[:2], key[2:])).get_data()
         except KeyError:
             raise KeyError(key)
-        if not d or not d.has_key('__book__'):
-            raise KeyError(key)
-        return d['__book__'].get_data()
 
     def put(self, data):
         book = self.book_type(self, '__unknown__')
         book.data  = data
-        book.name  = self.make_blob(book.serialize_data(book.data))
-        book.dirty = False      # the blob was just written!
+        book.name  = self.hash_blob(book.serialize_data(book.data))
+        book.dirty = True       # the blob is written by the next commit
         book.path  = '%s/%s' % (book.name[:2], book.name[2:])
 
-        d = self.get_tree(book.path, make_dirs = True)
-        d.clear()
-        d['__book__'] = book
-        self.dirty = True
+        (d, name) = self.get_parent(book.path, make_dirs = True)
+        d[name] = book
+        self.mark_dirty(book.path)
 
         return book.name
 
     def __getitem__(self, path):
-        d = None
-        try:
-            d = self.get_tree(path)
-        except KeyError:
-            raise KeyError(path)
-
-        if d and d.has_key('__book__'):
-            return d['__book__'].get_data()
-        else:
-            raise KeyError(path)
+        return self.get_book(path).get_data()
 
     def __setitem__(self, path, data):
-        d = self.get_tree(path, make_dirs = True)
-        if not d.has_key('__book__'):
-            d.clear()
-            d['__book__'] = self.book_type(self, path)
-        d['__book__'].set_data(data)
+        (d, name) = self.get_parent(path, make_dirs = True)
+        if not d.has_key(name) or not isinstance(d[name], gitbook):
+            d[name] = self.book_type(self, path)
+        d[name].set_data(data)
         self.dirty = True
 
+    def touch(self, path, data = None):
+        """Have the next commit write the data at path again, through a book
+        of the shelf's current book_type.  Data changed in place is given,
+        since the book may have let go of it and would read it back as it
+        was."""
+        book = self.get_book(path)
+        if data is None:
+            data = book.get_data()
+        self.cache.discard(book)
+        (d, name) = self.get_parent(path)
+        d[name] = self.book_type(self, path)
+        d[name].set_data(data)
+
     def prune_tree(self, objects, paths):
         if len(paths) > 1:
             left = self.prune_tree(objects[paths[0]], paths[1:])
@@ -465,37 +1539,44 @@ class gitshelve(dict):
             if left > 0 or len(objects[paths[0]]) > int(has_root):
                 if '__root__' in objects:
                     del objects['__root__']
-                for tree in objects:
-                    if '__root__' in objects[tree]:
-                        del objects[tree]['__root__']
+                if '__root__' in objects[paths[0]]:
+                    del objects[paths[0]]['__root__']
                 return 3
-        l = len(objects[paths[0]])
+        if isinstance(objects[paths[0]], gitbook):
+            l = 1
+        else:
+            l = len(objects[paths[0]])
         del objects[paths[0]]
         self.dirty = True
         return l-1
 
     def __delitem__(self, path):
         try:
+            self.get_tree(path)     # read the trees along the path
             self.prune_tree(self.objects, split(path, os.sep))
         except KeyError:
             raise KeyError(path)
+        self.mark_dirty(path)
 
     def __contains__(self, path):
-        d = self.get_tree(path)
-        return len(d.keys()) == 1 and d.has_key('__book__')
+        try:
+            self.get_book(path)
+        except KeyError:
+            return False
+        return True
 
     def walker(self, kind, objects, path = ''):
+        self.load_children(objects, path)
         for item in objects.items():
             if item[0] == '__root__': continue
-            assert isinstance(item[1], dict)
 
             if path:
                 key = join((path, item[0]), os.sep)
             else:
                 key = item[0]
 
-            if len(item[1].keys()) == 1 and item[1].has_key('__book__'):
-                value = item[1]['__book__']
+            if isinstance(item[1], gitbook):
+                value = item[1]
                 if kind == 'keys':
                     yield key
                 elif kind == 'values':
@@ -509,6 +1590,83 @@ class gitshelve(dict):
 
         raise StopIteration
 
+    def scan(self, objects, path, start, stop):
+        """Yield a (key, book) pair for every book below objects whose key
+        lies between start, inclusive, and stop, exclusive, in the order of
+        their keys.  Only the trees which may hold such keys are read, and
+        those at the same level are read together."""
+        entries = []
+        unread  = []
+        for name in objects.keys():
+            if name == '__root__': continue
+
+            if path:
+                key = '%s/%s' % (path, name)
+            else:
+                key = name
+
+            obj = objects[name]
+            if isinstance(obj, gitbook):
+                if (start is None or key >= start) and \
+                   (stop is None or key < stop):
+                    entries.append((key, key, obj))
+            else:
+                # Every key below the tree lies between key/ and key0, since
+                # '0' follows '/'.
+                if (start is None or key + '0' > start) and \
+                   (stop is None or key + '/' < stop):
+                    entries.append((key + '/', key, obj))
+                    if self.unread_tree(obj):
+                        unread.append((obj, key))
+        if unread:
+            self.read_trees(unread)
+
+        entries.sort()
+        for (order, key, obj) in entries:
+            if isinstance(obj, gitbook):
+                yield (key, obj)
+            else:
+                for item in self.scan(obj, key, start, stop):
+                    yield item
+
+    def prefetch(self, items, size):
+        """Pass on the (key, book) pairs from items, after reading the data
+        of every size of them from Git together."""
+        batch = []
+        for item in items:
+            batch.append(item)
+            if len(batch) == size:
+                self.read_books([book for (key, book) in batch])
+                for item in batch:
+                    yield item
+                batch = []
+        if batch:
+            self.read_books([book for (key, book) in batch])
+            for item in batch:
+                yield item
+
+    def iterrange(self, start = None, stop = None, prefetch = 0):
+        """Yield a (key, book) pair for every key from start up to, but not
+        including, stop, in sorted order.  With prefetch, the data of the
+        books is read that many at a time, ahead of being needed."""
+        items = self.scan(self.objects, '', start, stop)
+        if prefetch:
+            items = self.prefetch(items, prefetch)
+        return items
+
+    def iterprefix(self, prefix, prefetch = 0):
+        """Yield a (key, book) pair for every key starting with prefix, in
+        sorted order."""
+        # The keys starting with prefix come before the first string which
+        # is greater than all of them; a trailing '\xff' cannot be
+        # incremented, so the character before it is.
+        stop = prefix.rstrip('\xff')
+        if stop:
+            stop = stop[:-1] + chr(ord(stop[-1]) + 1)
+        else:
+            stop = None
+        return self.iterrange(prefix or None, stop, prefetch)
+
     def __iter__(self):
         return self.iterkeys()
     
@@ -531,20 +1689,27 @@ class gitshelve(dict):
         self.sync()                  # synchronize before persisting
         odict = self.__dict__.copy() # copy the dict since we change it
         del odict['dirty']           # remove dirty flag
+        if odict.has_key('reader'):
+            del odict['reader']      # the pipe cannot be persisted
+        if odict.has_key('cache'):
+            del odict['cache']       # nor are the books kept track of
         return odict
 
     def __setstate__(self, ndict):
         self.__dict__.update(ndict) # update attributes
         self.dirty = False
+        self.ahead = []
+        self.cache = gitcache(self.cache_entries, self.cache_bytes)
 
-        # If the HEAD reference is out of date, throw away all data and
-        # rebuild it.
-        if not self.head or self.head != self.current_head():
-            self.read_repository()
+        # If the HEAD reference is out of date, bring over only the changes
+        # made since.
+        self.refresh()
 
 
 def open(branch = 'master', repository = None, keep_history = True,
-         book_type = gitbook):
-    return gitshelve.open(branch, repository, keep_history, book_type)
+         book_type = gitbook, fast_import = False, lazy = False,
+         cache_entries = None, cache_bytes = None):
+    return gitshelve.open(branch, repository, keep_history, book_type,
+                          fast_import, lazy, cache_entries, cache_bytes)
 
 # gitshelve.py ends here
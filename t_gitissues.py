@@ -0,0 +1,915 @@
+# -*- coding: utf-8 -*-
+
+# Tests of git-issues, which run its commands as the shell would, each in a
+# process of its own, against a throwaway repository.  What cannot be seen
+# from the outside is tested through git-issues loaded as a module.
+
+import sys
+import re
+import imp
+import json
+import os
+import os.path
+import shutil
+import socket
+import unittest
+
+from subprocess import Popen, PIPE, STDOUT
+from tempfile   import mkdtemp
+from datetime   import datetime
+
+try:
+    from cStringIO import StringIO
+except:
+    from StringIO import StringIO
+
+here        = os.path.dirname(os.path.abspath(__file__))
+issues_exec = os.path.join(here, 'git-issues')
+
+sys.dont_write_bytecode = True
+gitissues = imp.load_source('gitissues', issues_exec)
+
+class t_gitissues(unittest.TestCase):
+    def setUp(self):
+        self.repository = mkdtemp(prefix = 't_gitissues-')
+        self.environ = os.environ.copy()
+        self.environ.update({ 'GIT_AUTHOR_NAME':     'Tester',
+                              'GIT_AUTHOR_EMAIL':    'tester@example.com',
+                              'GIT_COMMITTER_NAME':  'Tester',
+                              'GIT_COMMITTER_EMAIL': 'tester@example.com',
+                              'GIT_ISSUES_LOCAL':    '1' })
+        self.init(self.repository)
+
+    def tearDown(self):
+        shutil.rmtree(self.repository)
+
+    def run_in(self, cwd, argv, input = None, status = 0, environ = None):
+        proc = Popen(argv, cwd = cwd, env = environ or self.environ,
+                     stdin = PIPE, stdout = PIPE, stderr = STDOUT)
+        output = proc.communicate(input)[0]
+        self.assertEqual(status, proc.returncode,
+                         "%s exited with %d:\n%s" %
+                         (' '.join(argv), proc.returncode, output))
+        return output
+
+    def git(self, *args, **kwargs):
+        cwd = kwargs.get('cwd', self.repository)
+        return self.run_in(cwd, ('git',) + args).strip()
+
+    def init(self, repository, name = 'Tester'):
+        self.git('init', '-q', repository)
+        self.git('config', 'user.name', name, cwd = repository)
+        self.git('config', 'user.email', '%s@example.com' % name.lower(),
+                 cwd = repository)
+
+    def issue_sets(self, count):
+        """Return count GitIssueSets of the repository, as if each were in a
+        process of its own.  The current directory is the repository's until
+        the test ends."""
+        cwd = os.getcwd()
+        os.chdir(self.repository)
+        self.addCleanup(os.chdir, cwd)
+        sets = []
+        for i in range(count):
+            issueSet = gitissues.GitIssueSet().load_state()
+            issueSet.shelf.retry_delay = 0
+            sets.append(issueSet)
+        return sets
+
+    def issues(self, *args, **kwargs):
+        """Run git-issues with the given arguments, and return its output."""
+        cwd = kwargs.pop('cwd', self.repository)
+        return self.run_in(cwd, [sys.executable, issues_exec] + list(args),
+                           **kwargs)
+
+    def new(self, title, **kwargs):
+        """Create an issue, and return its name."""
+        output = self.issues('--print-new-bugs', 'new', title, **kwargs)
+        return re.search(r'\(([0-9a-f]{7})\)', output).group(1)
+
+    def titles(self, *args, **kwargs):
+        """Return the titles listed by git-issues list, sorted."""
+        output = self.issues('list', '--screen-width=100', *args, **kwargs)
+        titles = re.findall(r'(?m)^ *\d+  [0-9a-f]{7}  (.*?)  ', output)
+        titles.sort()
+        return titles
+
+    def testCacheInvalidation(self):
+        self.new('First issue')
+        self.assertEqual(['First issue'], self.titles())
+        first = self.git('rev-parse', 'issues')
+
+        # Another clone commits to the branch behind the cache's back.
+        clone = os.path.join(self.repository, 'clone')
+        self.git('clone', '-q', '--no-checkout', self.repository, clone)
+        self.git('fetch', '-q', 'origin', 'issues:issues', cwd = clone)
+        self.git('config', 'user.name', 'Other', cwd = clone)
+        self.git('config', 'user.email', 'other@example.com', cwd = clone)
+        self.new('Second issue', cwd = clone)
+        self.git('push', '-q', 'origin', 'issues', cwd = clone)
+
+        self.assertEqual(['First issue', 'Second issue'], self.titles())
+        cache = open(os.path.join(self.repository, '.git',
+                                  'issues-cache')).readline()
+        self.assertEqual(self.git('rev-parse', 'issues'), cache.split()[2])
+
+        # Moving the branch back forgets what the cache learnt since.
+        self.git('update-ref', 'refs/heads/issues', first)
+        self.assertEqual(['First issue'], self.titles())
+
+    def testListFilters(self):
+        ui     = self.new('User interface')
+        core   = self.new('Core')
+        both   = self.new('Both')
+        closed = self.new('Closed')
+        self.issues('change', ui, 'tags', 'ui')
+        self.issues('change', core, 'tags', 'core')
+        self.issues('change', core, 'milestone', '1.0')
+        self.issues('change', both, 'tags', 'ui, core')
+        self.issues('change', both, 'assigned', 'Alice')
+        self.issues('change', closed, 'tags', 'ui')
+        self.issues('close', closed)
+
+        self.assertEqual(['Both', 'Core', 'User interface'], self.titles())
+        self.assertEqual(['Both', 'Closed', 'Core', 'User interface'],
+                         self.titles('--filter-status='))
+        self.assertEqual(['Closed'], self.titles('--filter-status=TODO'))
+        self.assertEqual(['Both', 'User interface'],
+                         self.titles('--filter-tags=ui'))
+        self.assertEqual(['Both', 'Core', 'User interface'],
+                         self.titles('--filter-tags=ui:core'))
+        self.assertEqual(['Both'], self.titles('--filter-assigned=Alice'))
+        self.assertEqual(['Core'], self.titles('--filter-milestone=1.0'))
+        self.assertEqual(['Core'], self.titles('--filter-milestone=1.0',
+                                               '--filter-tags=core'))
+        self.assertEqual([], self.titles('--filter-milestone=1.0',
+                                          '--filter-tags=ui'))
+
+        # The index follows the changes made since it was written.
+        self.issues('change', ui, 'tags', 'core')
+        self.issues('close', both)
+        self.assertEqual(['Core', 'User interface'],
+                         self.titles('--filter-tags=core'))
+        self.assertEqual([], self.titles('--filter-assigned=Alice'))
+
+    def testExportImport(self):
+        first  = self.new('First issue')
+        second = self.new('Second issue')
+        self.issues('change', first, 'title', 'Renamed issue')
+        self.issues('comment', first, 'A comment')
+        self.issues('comment', first, 'Another comment')
+        self.issues('change', second, 'tags', 'ui, core')
+        self.issues('close', second)
+
+        inline = self.issues('export', '--inline-comments')
+        nested = self.issues('export')
+        self.assertEqual(4, len(inline.splitlines()))
+        self.assertEqual(2, len(nested.splitlines()))
+
+        # Another repository imports the same issues and comments, under the
+        # same names.
+        other = os.path.join(self.repository, 'other')
+        self.init(other)
+        self.assertEqual("Imported 2 issues and 2 comments in 1 commits\n",
+                         self.issues('import', input = inline, cwd = other))
+        self.assertEqual(inline, self.issues('export', '--inline-comments',
+                                             cwd = other))
+
+        # Importing an export again replaces what it was exported from.
+        self.issues('import', input = inline)
+        self.issues('import', input = nested)
+        self.assertEqual(inline, self.issues('export', '--inline-comments'))
+        self.assertEqual(['Renamed issue'], self.titles())
+
+        # Numbers are imported as text, and an id which is not a name is
+        # left for the issue to be named anew.
+        third = os.path.join(self.repository, 'third')
+        self.init(third)
+        self.issues('import', cwd = third,
+                    input = '{"id": 17, "title": "Numbered", "version": 2, '
+                            '"tags": ["ui", 3]}\n'
+                            '{"record": "comment", "comment": 42}\n')
+        record = json.loads(self.issues('export', cwd = third))
+        self.assertEqual(('Numbered', '2', ['ui', '3'], '42'),
+                         (record['title'], record['version'], record['tags'],
+                          record['comments'][0]['comment']))
+        self.assertNotEqual('17', record['id'])
+
+        # A record which cannot be imported stops the import before anything
+        # is committed.
+        head = self.git('rev-parse', 'issues', cwd = third)
+        for (records, error) in \
+                (('{"title": "Silent"}\n{"record": "comment"}\n',
+                  'A comment cannot be imported without its text.'),
+                 ('{"title": "Odd", "version": {"major": 2}}\n',
+                  'The field version cannot be imported from'),
+                 ('{"version": "2"}\n',
+                  'An issue cannot be imported without a title.')):
+            output = self.issues('import', cwd = third, input = records,
+                                 status = 1)
+            self.assert_(error in output, output)
+        self.assertEqual(head, self.git('rev-parse', 'issues', cwd = third))
+
+    def exported(self, *args):
+        """Return the title of each issue exported, with the number of its
+        comments."""
+        return [(record['title'], len(record.get('comments', [])))
+                for record in [json.loads(line) for line in
+                               self.issues('export', *args).splitlines()]]
+
+    def testExport(self):
+        first  = self.new('First issue')
+        second = self.new('Second issue')
+        third  = self.new('Third issue')
+        self.issues('comment', second, 'A comment')
+        self.issues('change', second, 'tags', 'ui, core')
+        self.issues('close', second)
+        self.issues('change', third, 'tags', 'ui')
+
+        self.assertEqual([('First issue', 0), ('Second issue', 1),
+                          ('Third issue', 0)], sorted(self.exported()))
+        self.assertEqual([('Second issue', 1)],
+                         self.exported('--status=closed'))
+        self.assertEqual([('First issue', 0), ('Third issue', 0)],
+                         sorted(self.exported('--status=TODO:open')))
+        self.assertEqual([('Second issue', 1)], self.exported('--tags=core'))
+        self.assertEqual([('Second issue', 1), ('Third issue', 0)],
+                         sorted(self.exported('--tags=ui')))
+
+        # With --since, only the issues changed since are exported, whole.
+        since = self.git('rev-parse', 'issues')
+        self.assertEqual([], self.exported('--since=%s' % since))
+        self.issues('comment', second, 'Another comment')
+        self.issues('change', first, 'status', 'open')
+        self.assertEqual([('First issue', 0), ('Second issue', 2)],
+                         sorted(self.exported('--since=%s' % since)))
+
+    def testConcurrentComments(self):
+        name = self.new('Commented issue')
+
+        # Commenting on the same issue only writes the comments, so both
+        # writers get theirs in.
+        (first, second) = self.issue_sets(2)
+        first.new_comment(first[name], 'First comment')
+        second.new_comment(second[name], 'Second comment')
+        first.save_state()
+        second.save_state()
+
+        record = json.loads(self.issues('export'))
+        self.assertEqual(['First comment', 'Second comment'],
+                         sorted([comment['comment']
+                                 for comment in record['comments']]))
+        self.assertEqual(['Change issue %s: comments' % name] * 2,
+                         self.git('log', '-2', '--format=%s',
+                                  'issues').splitlines())
+        self.assertEqual('comments', json.loads(self.git(
+            'log', '-1', '--format=%(trailers:key=Issue-Change,valueonly)',
+            'issues'))['field'])
+
+    def testIssueComments(self):
+        self.issues('import', input = json.dumps(
+            {"title": "Commented issue", "comments": [
+                {"comment": "Second", "created": "2011-02-01T00:00:00",
+                 "author": "Bob <bob@example.com>"},
+                {"comment": "First", "created": "2011-01-01T00:00:00",
+                 "author": "Alice <alice@example.com>"},
+                {"comment": "Third", "created": "2011-03-01T00:00:00",
+                 "author": "Carol <carol@example.com>"}]}) + '\n')
+        self.issues('import', input = json.dumps(
+            {"title": "Other issue", "comments": [
+                {"comment": "Elsewhere"}]}) + '\n')
+        (issueSet,) = self.issue_sets(1)
+        issue = [issueSet[i] for i in ('1', '2')
+                 if issueSet[i].title == 'Commented issue'][0]
+
+        # Oldest first, each knowing its issue and name, and only the
+        # issue's own.
+        comments = issueSet.issue_comments(issue)
+        self.assertEqual(['First', 'Second', 'Third'],
+                         [comment.comment for comment in comments])
+        self.assertEqual(['Alice', 'Bob', 'Carol'],
+                         [comment.author.name for comment in comments])
+        self.assertEqual([datetime(2011, 1, 1), datetime(2011, 2, 1),
+                          datetime(2011, 3, 1)],
+                         [comment.created for comment in comments])
+        for comment in comments:
+            self.assert_(comment.issue is issue)
+            self.assertEqual(comment.comment,
+                             issueSet.get_comment(comment.name).comment)
+
+        # A comment added in this process comes last, before and after it
+        # is committed.
+        added = issueSet.new_comment(issue, 'Fourth')
+        self.assertEqual(['First', 'Second', 'Third', 'Fourth'],
+                         [comment.comment for comment in
+                          issueSet.issue_comments(issue)])
+        self.assertEqual(added.name, issueSet.issue_comments(issue)[-1].name)
+        issueSet.save_state()
+        self.assertEqual(['First', 'Second', 'Third', 'Fourth'],
+                         [comment.comment for comment in
+                          issueSet.issue_comments(issue)])
+
+    def testCacheBudget(self):
+        names = [self.new('Issue %d' % i) for i in range(4)]
+        self.git('config', 'issues.cacheEntries', '2')
+        self.git('config', 'issues.cacheBytes', '100000')
+
+        (issueSet,) = self.issue_sets(1)
+        self.assertEqual(2, issueSet.shelf.cache.max_entries)
+        self.assertEqual(100000, issueSet.shelf.cache.max_bytes)
+
+        # An issue whose book lets go of it while it is being changed is
+        # written as changed, not as read back again.
+        first = issueSet[names[0]]
+        path  = issueSet.issue_path(first)
+        for name in names[1:]:
+            issueSet[name]
+        self.assertEqual(None, issueSet.shelf.get_book(path).data)
+        first.set_title('Changed while evicted')
+        for name in names[1:]:
+            issueSet[name]
+        issueSet.save_state()
+        self.assert_(issueSet.shelf.cache.stats()['evictions'] > 0)
+
+        self.assertEqual(['Changed while evicted', 'Issue 1', 'Issue 2',
+                          'Issue 3'], self.titles())
+        self.assertEqual('Change issue %s: title' % names[0],
+                         self.git('log', '-1', '--format=%s', 'issues'))
+
+        self.git('config', 'issues.cacheEntries', 'many')
+        output = self.issues('list', status = 1)
+        self.assert_("The setting issues.cacheentries is not a number: many"
+                     in output, output)
+
+    def fields(self, obj):
+        """Return the fields an object is written with, as they export."""
+        return dict([(field, gitissues.export_value(getattr(obj, attr, None)))
+                     for (field, attr) in
+                     gitissues.record_types[gitissues.record_type(obj)]])
+
+    def testFormats(self):
+        Person = gitissues.Person
+        jane   = Person('Jane Doe', 'jane@example.com')
+        issue  = gitissues.Issue(None, jane, 'A <b>bold</b> & "quoted" title')
+        issue.created     = datetime(2008, 5, 12, 10, 30, 0, 123456)
+        issue.modified    = datetime(2008, 5, 13)
+        issue.summary     = ''
+        issue.description = '\nIndented\n  lines, and \xc3\xa9t\xc3\xa9\n'
+        issue.reporters   = [jane, Person('Jo', 'jo@example.com')]
+        issue.assigned    = Person('Ren\xc3\xa9', 'rene@example.com')
+        issue.components  = []
+        issue.tags        = ['ui', '', 'core']
+        issue.issue_type  = 'enhancement'
+        comment = gitissues.Comment(None, jane, 'Line one\nLine two\n')
+        comment.created     = datetime(2008, 5, 14, 9, 0, 0)
+        comment.attachments = [['log.txt', '0' * 40], ['b<a>d', '1' * 40]]
+        issueSet = gitissues.IssueSet(None)
+        issueSet.statuses    = ['open', 'closed']
+        issueSet.issue_types = ['defect']
+        issueSet.versions    = ['1.0']
+
+        for write in (gitissues.object_to_string, gitissues.object_to_json):
+            for obj in (issue, comment, issueSet):
+                data = write(obj)
+                read = gitissues.object_from_string(data)
+                self.assertEqual(obj.__class__, read.__class__)
+                self.assertEqual(self.fields(obj), self.fields(read), data)
+            read = gitissues.object_from_string(write(issue))
+            self.assertEqual(('', None), (read.summary, read.resolution))
+            self.assert_(isinstance(read.assigned, Person))
+            self.assertEqual(str(issue.assigned), str(read.assigned))
+
+        # XML leaves out the control characters it cannot hold, which JSON
+        # keeps; both keep carriage returns.
+        comment.comment = 'Bell\x07, tab\t, CRLF\r\nand NUL\x00'
+        self.assertEqual('Bell, tab\t, CRLF\r\nand NUL',
+                         gitissues.object_from_string(
+                             gitissues.object_to_string(comment)).comment)
+        self.assertEqual(comment.comment,
+                         gitissues.object_from_string(
+                             gitissues.object_to_json(comment)).comment)
+        comment.comment = '\x01'
+        self.assertEqual('', gitissues.object_from_string(
+            gitissues.object_to_string(comment)).comment)
+
+    # Books as git-issues wrote them before version 2 of the XML format,
+    # whose text minidom padded with newlines.
+    version1_issue = """<?xml version="1.0" encoding="utf-8"?>
+<issue>
+<created>
+<datetime>
+20080512T103000
+</datetime>
+</created>
+<author>
+<person>
+<name>
+Jane Doe
+</name>
+<email>
+jane@example.com
+</email>
+</person>
+</author>
+<title>
+Old issue
+</title>
+<summary/>
+<description>
+Line one
+Line two
+</description>
+<reporters>
+<list/>
+</reporters>
+<assigned/>
+<status>
+open
+</status>
+<tags>
+<list/>
+</tags>
+<modified/>
+<type>
+defect
+</type>
+</issue>
+"""
+    version1_comment = """<?xml version="1.0" encoding="utf-8"?>
+<comment>
+<created>
+<datetime>
+20080513T110000
+</datetime>
+</created>
+<author>
+<person>
+<name>
+Jane Doe
+</name>
+<email>
+jane@example.com
+</email>
+</person>
+</author>
+<comment>
+A &lt;b&gt;comment&lt;/b&gt; &amp; more
+</comment>
+</comment>
+"""
+
+    def testVersion1(self):
+        issue = gitissues.object_from_string(self.version1_issue)
+        self.assertEqual({ 'created':     '2008-05-12T10:30:00.000000',
+                           'author':      'Jane Doe <jane@example.com>',
+                           'title':       'Old issue',
+                           'summary':     None,
+                           'description': 'Line one\nLine two',
+                           'reporters':   [],
+                           'owners':      [],
+                           'assigned':    None,
+                           'carbons':     [],
+                           'status':      'open',
+                           'resolution':  None,
+                           'components':  [],
+                           'version':     None,
+                           'milestone':   None,
+                           'severity':    'major',
+                           'priority':    'medium',
+                           'tags':        [],
+                           'modified':    None,
+                           'type':        'defect' }, self.fields(issue))
+
+        comment = gitissues.object_from_string(self.version1_comment)
+        self.assertEqual(datetime(2008, 5, 13, 11), comment.created)
+        self.assertEqual('A <b>comment</b> & more', comment.comment)
+        self.assertEqual('Jane Doe', comment.author.name)
+
+        # Written again, they are written in the current version.
+        data = gitissues.object_to_string(issue)
+        self.assert_('<issue version="2">' in data)
+        self.assertEqual(self.fields(issue), self.fields(
+            gitissues.object_from_string(data)))
+
+    def testMigrate(self):
+        first  = self.new('First issue')
+        second = self.new('Second issue')
+        self.issues('comment', first, 'A comment\nover two lines')
+        self.issues('comment', second, 'Another <comment> & more')
+        self.issues('change', second, 'tags', 'ui, core')
+        self.issues('change', second, 'summary', '')
+        exported = self.issues('export', '--inline-comments')
+
+        paths = self.git('ls-tree', '-r', '--name-only',
+                         'issues').splitlines()
+        self.assertEqual(4, len(paths))
+        for (format, start) in (('json', '{'), ('xml', '<?xml')):
+            self.issues('migrate', format)
+            self.assertEqual(format, self.git('config', 'issues.format'))
+            for path in paths:
+                self.assert_(self.git('cat-file', 'blob', 'issues:' + path)
+                             .startswith(start), path)
+            self.assertEqual(exported, self.issues('export',
+                                                   '--inline-comments'))
+        self.assertEqual(['First issue', 'Second issue'], self.titles())
+
+    def testIdIndex(self):
+        ids = gitissues.IdIndex()
+        for name in ('b2', 'a1', 'b1', 'c3'):
+            ids.add(name, 'path of %s' % name)
+        self.assertEqual(4, len(ids))
+        self.assertEqual(['a1', 'b1', 'b2', 'c3'],
+                         [ids.at(i) for i in range(len(ids))])
+        self.assertEqual(['b1', 'b2'], ids.find('b'))
+        self.assertEqual(['b2'], ids.find('b2'))
+        self.assertEqual([], ids.find('d'))
+        self.assertEqual([], ids.find(''))
+        self.assertEqual(2, ids.position('b2'))
+        self.assertEqual('path of c3', ids.path('c3'))
+
+        ids.remove('b1')
+        ids.remove('nothing')
+        self.assertEqual(['b2'], ids.find('b'))
+        self.assertEqual(1, ids.position('b2'))
+
+    def unique_prefix(self, ids, name):
+        """Return the shortest prefix of name which finds only it."""
+        length = 1
+        while len(ids.find(name[:length])) > 1 or \
+              (name[:length].isdigit() and
+               0 < int(name[:length]) <= len(ids)):
+            length += 1
+        return name[:length]
+
+    def testResolve(self):
+        self.issues('import', input = ''.join(
+            ['{"title": "Issue %d", "comments": [{"comment": "On %d"}]}\n' %
+             (i, i) for i in range(20)]))
+        (issueSet,) = self.issue_sets(1)
+
+        # The comments are found without any tree of the shelf being read.
+        comment_ids = issueSet.get_comment_ids()
+        self.assertEqual(20, len(comment_ids))
+        for key in issueSet.shelf.objects.keys():
+            if key != '__root__':
+                self.assert_(issueSet.shelf.unread_tree(
+                    issueSet.shelf.objects[key]))
+
+        ids   = issueSet.get_issue_ids()
+        names = [ids.at(i) for i in range(len(ids))]
+        self.assertEqual(sorted(names), names)
+
+        # By number, in the order of the names, or by a unique prefix; a
+        # prefix which is also a number is taken as the number.
+        self.assertEqual(names[0], issueSet['1'].get_name())
+        self.assertEqual(names[19], issueSet['20'].get_name())
+        for name in names:
+            issue = issueSet[self.unique_prefix(ids, name)]
+            self.assertEqual(name, issue.get_name())
+            comment = issueSet.issue_comments(issue)[0]
+            self.assertEqual(issue.title.replace('Issue', 'On'),
+                             issueSet.get_comment(self.unique_prefix(
+                                 comment_ids, comment.name)).comment)
+
+        # An ambiguous prefix lists the names it matches.
+        ambiguous = gitissues.IdIndex()
+        for name in ('ab12', 'ab34', 'ac56'):
+            ambiguous.add(name, name)
+        stdout = sys.stdout
+        sys.stdout = StringIO()
+        try:
+            self.assertEqual(None, issueSet.resolve(ambiguous, 'ab'))
+            output = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+        self.assertEqual("Ambiguous hash matches:\n\tab12\n\tab34\n", output)
+        self.assertEqual('ac56', issueSet.resolve(ambiguous, 'ac'))
+        self.assertEqual('ab34', issueSet.resolve(ambiguous, '2'))
+
+        for unknown in ('xyz', '-1', 'f' * 40):
+            try:
+                issueSet[unknown]
+                self.fail("%s was found" % unknown)
+            except Exception, e:
+                self.assertEqual("There is no issue matching the identifier "
+                                 "'%s'.\n" % unknown, str(e))
+
+        # Comments added or removed since the last commit are known too.
+        first = issueSet[names[0]]
+        added = issueSet.new_comment(first, 'Not committed')
+        del issueSet[names[1]]
+        issueSet.comment_ids = None
+        comment_ids = issueSet.get_comment_ids()
+        self.assertEqual(20, len(comment_ids))
+        self.assertEqual([added.name], comment_ids.find(added.name))
+        self.assertEqual('Not committed',
+                         issueSet.get_comment(added.name).comment)
+
+    def run_command(self, issueSet, *args):
+        """Run a command of git-issues against the issue set given, as a
+        server does, and return its output and exit status."""
+        stdout = sys.stdout
+        sys.stdout = StringIO()
+        try:
+            try:
+                gitissues.run(list(args), issueSet)
+                status = 0
+            except SystemExit, e:
+                status = e.code
+            return (sys.stdout.getvalue(), status)
+        finally:
+            sys.stdout = stdout
+
+    def testConflict(self):
+        name = self.new('Contested issue')
+
+        # Another writer changes the issue after it was read, and before the
+        # change made to it here is committed.
+        (issueSet,) = self.issue_sets(1)
+        issueSet[name]
+        self.issues('change', name, 'status', 'open')
+        head = self.git('rev-parse', 'issues')
+
+        (output, status) = self.run_command(issueSet, 'close', name)
+        self.assertEqual(1, status)
+        self.assertEqual("Cannot commit, since another writer changed these "
+                         "as well:\n  %s\nThe change was not committed.\n" %
+                         issueSet.issue_path(issueSet[name]), output)
+        self.assertEqual(head, self.git('rev-parse', 'issues'))
+        self.assertEqual('open', json.loads(self.issues('export'))['status'])
+
+    def request(self, socket_path, argv):
+        """Send a command to a server as a client does, and return its
+        output and exit status."""
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(socket_path)
+        try:
+            sock.sendall(json.dumps({ 'argv':    argv,
+                                      'cwd':     self.repository,
+                                      'columns': None }) + '\n')
+            replies = sock.makefile('rb')
+            output  = ''
+            while True:
+                header = replies.read(9)
+                data   = replies.read(int(header[1:], 16))
+                if header[0] == 'x':
+                    return (output, int(data))
+                output += data
+        finally:
+            sock.close()
+
+    def testExportAttachments(self):
+        name = self.new('Issue with a file')
+        filename = os.path.join(self.repository, 'attached.bin')
+        data = ''.join([chr(i % 256) for i in range(100000)])
+        fd = open(filename, 'wb')
+        fd.write(data)
+        fd.close()
+        self.issues('attach', name, filename, 'Here is the file')
+        since = self.git('rev-parse', 'issues~1')
+
+        # The attachment is listed with its comment, but not read.
+        for args in ([], ['--since=%s' % since]):
+            record = json.loads(self.issues('export', *args))
+            self.assertEqual('Here is the file',
+                             record['comments'][0]['comment'])
+            self.assertEqual('attached.bin',
+                             record['comments'][0]['attachments'][0][0])
+
+        comment = str(record['comments'][0]['id'])
+        self.assertEqual(data, self.issues('extract', comment, '-'))
+
+    def testServer(self):
+        first = self.new('First issue')
+
+        local = self.environ
+        self.environ = local.copy()
+        del self.environ['GIT_ISSUES_LOCAL']
+        socket_path = os.path.join(self.repository, '.git', 'issues-server')
+        server = Popen([sys.executable, issues_exec, 'serve'],
+                       cwd = self.repository, env = self.environ,
+                       stdout = PIPE, stderr = STDOUT)
+        try:
+            self.assert_(server.stdout.readline().startswith('Serving'))
+
+            (output, status) = self.request(socket_path, ['show', first])
+            self.assertEqual(0, status)
+            self.assert_('Title: First issue' in output)
+            (output, status) = self.request(socket_path, ['show', 'fffffff'])
+            self.assertEqual(1, status)
+            self.assert_('There is no issue matching' in output)
+
+            # The commands of clients go through the server.
+            self.new('Second issue')
+            self.assertEqual(['First issue', 'Second issue'], self.titles())
+            self.issues('show', 'fffffff', status = 1)
+
+            # The server sees what another writer commits.
+            self.new('Third issue', environ = local)
+            self.assertEqual(['First issue', 'Second issue', 'Third issue'],
+                             self.titles())
+        finally:
+            server.terminate()
+            server.wait()
+        self.failIf(os.path.exists(socket_path))
+
+    def testRunsLocally(self):
+        # Only the command decides, wherever its options are.
+        for argv in (['serve'], ['edit', '1'], ['init'],
+                     ['--verbose', 'init'], ['--format', 'json', 'edit', '1'],
+                     ['import'], ['import', '-'], ['import', '--format=csv'],
+                     ['--batch-size', '10', 'batch'], ['import', '--', '-']):
+            self.assert_(gitissues.runs_locally(argv), argv)
+
+        # Not the arguments of another command, nor the values of options.
+        for argv in ([], ['list'], ['new', 'serve'], ['comment', '1', 'edit'],
+                     ['show', 'init'], ['new', 'import'],
+                     ['--status', 'edit', 'list'], ['--tags=init', 'list'],
+                     ['--format', 'serve', 'export'],
+                     ['import', 'issues.jsonl'],
+                     ['--batch-size', '10', 'batch', 'commands'],
+                     ['--', 'list', 'edit']):
+            self.failIf(gitissues.runs_locally(argv), argv)
+
+    def testBatch(self):
+        commands = """new 'Batch issue'
+# Blank lines and comments are skipped.
+
+comment 1 'A comment'
+change 1 nosuchfield value
+frobnicate 1
+close fffffff
+new 'Unterminated
+change 1 milestone 2.0
+close 1
+"""
+        output = self.issues('batch', input = commands, status = 1)
+        lines  = output.splitlines()
+        self.assertEqual(9, len(lines))
+        name = re.match(r'1: new ([0-9a-f]{7})$', lines[0]).group(1)
+        self.assert_(re.match(r'4: comment [0-9a-f]{7}$', lines[1]))
+        self.assertEqual(['5: error: Unknown field nosuchfield',
+                          '6: error: Unknown command frobnicate',
+                          "7: error: There is no issue matching the "
+                          "identifier 'fffffff'.",
+                          '8: error: No closing quotation',
+                          '9: change %s' % name,
+                          '10: close %s' % name,
+                          'Ran 4 commands, 4 failed'], lines[2:])
+
+        # What succeeded was committed, together.
+        self.assertEqual('Batch of 4 commands',
+                         self.git('log', '-1', '--format=%s', 'issues'))
+        self.assertEqual('1', self.git('rev-list', '--count', 'issues'))
+        record = json.loads(self.issues('export'))
+        self.assertEqual(('Batch issue', 'closed', '2.0', 1),
+                         (record['title'], record['status'],
+                          record['milestone'], len(record['comments'])))
+
+    def testMerge(self):
+        name = self.new('Merged issue')
+
+        clone = os.path.join(self.repository, 'clone')
+        self.init(clone, 'Other')
+        self.git('fetch', '-q', self.repository, 'issues:issues', cwd = clone)
+
+        # Both sides change the status, but only one the milestone, and each
+        # adds a comment.
+        self.issues('change', name, 'status', 'closed', cwd = clone)
+        self.issues('change', name, 'milestone', '2.0', cwd = clone)
+        self.issues('comment', name, 'Comment from the clone', cwd = clone)
+        self.issues('comment', name, 'Comment from here')
+        self.issues('change', name, 'status', 'open')
+
+        self.git('fetch', '-q', clone, 'issues:refs/remotes/clone/issues')
+        output = self.issues('merge', 'clone/issues')
+        self.assert_(output.startswith('Merged clone/issues into the issues '
+                                       'branch at '))
+        self.assertEqual(2, len(self.git('log', '-1', '--format=%P',
+                                         'issues').split()))
+
+        # The status changed last wins, and everything else is kept.
+        record = json.loads(self.issues('export'))
+        self.assertEqual(('open', '2.0'),
+                         (record['status'], record['milestone']))
+        self.assertEqual(['Comment from here', 'Comment from the clone'],
+                         sorted([comment['comment']
+                                 for comment in record['comments']]))
+        self.assertEqual(['Merged issue'], self.titles())
+
+        # Merging it again changes nothing.
+        head = self.git('rev-parse', 'issues')
+        self.issues('merge', 'clone/issues')
+        self.assertEqual(head, self.git('rev-parse', 'issues'))
+
+    def testHistory(self):
+        name = self.new('Tracked issue')
+        self.issues('change', name, 'status', 'open')
+        self.issues('comment', name, 'A comment')
+
+        # Each commit has a subject of its own, and the changes it made as
+        # trailers which Git can read.
+        self.assertEqual(['Change issue %s: comments' % name,
+                          'Change issue %s: status' % name,
+                          'Add issue %s: Tracked issue' % name],
+                         self.git('log', '--format=%s',
+                                  'issues').splitlines())
+        changes = self.git('log', '-1', '--format=%(trailers:key=Issue-Change,'
+                           'valueonly,unfold)', 'issues~1')
+        self.assertEqual({ 'field': 'status', 'from': 'TODO', 'to': 'open' },
+                         dict([(key, value) for (key, value) in
+                               json.loads(changes).items()
+                               if key != 'issue']))
+
+        # The latest entries are read alone, and kept only with the rest.
+        history = os.path.join(self.repository, '.git', 'issues-history')
+        output  = self.issues('history', '--max-count=1', name)
+        self.assertEqual(['Change issue %s: comments' % name],
+                         re.findall(r'(?m)^    (Change.*|Add.*)$', output))
+        self.failIf(os.path.exists(history))
+        output = self.issues('history', name)
+        self.assertEqual(3, len(re.findall(r'(?m)^    (Change.*|Add.*)$',
+                                           output)))
+        self.assert_(os.path.exists(history))
+
+        self.issues('close', name)
+        output = self.issues('history', '--max-count=2', name)
+        self.assertEqual(['Change issue %s: status' % name,
+                          'Change issue %s: comments' % name],
+                         re.findall(r'(?m)^    (Change.*|Add.*)$', output))
+
+    def found(self, *words):
+        """Return the titles of the issues search finds, sorted."""
+        output = self.issues('search', *words)
+        titles = re.findall(r'(?m)^[0-9a-f]{7}  (.*?)  ', output)
+        titles.sort()
+        return titles
+
+    def testSearch(self):
+        crash = self.new('Frobnicator crashes')
+        slow  = self.new('Parser is slow')
+        other = self.new('Unrelated')
+        self.issues('comment', crash, 'A segfault in the parser')
+
+        self.assertEqual(['Frobnicator crashes', 'Parser is slow'],
+                         self.found('parser'))
+        self.assertEqual(['Frobnicator crashes', 'Parser is slow'],
+                         self.found('pars*'))
+        self.assertEqual(['Frobnicator crashes'], self.found('FROB*'))
+        self.assertEqual(['Frobnicator crashes'],
+                         self.found('pars*', 'crash*'))
+        self.assertEqual([], self.found('pars*', 'unrel*'))
+        self.assertEqual([], self.found('nothing*'))
+
+        # The index follows what changed since it was written.
+        self.issues('change', other, 'title', 'Parsing rewrite')
+        self.assertEqual(['Frobnicator crashes', 'Parser is slow',
+                          'Parsing rewrite'], self.found('pars*'))
+        self.assertEqual([], self.found('unrel*'))
+
+    def testProfile(self):
+        self.new('Profiled issue')
+
+        # The report goes to standard error, after the command's output, and
+        # counts the same Git processes as Git itself does.
+        trace   = os.path.join(self.repository, 'trace')
+        environ = self.environ.copy()
+        environ['GIT_TRACE'] = trace
+        proc = Popen([sys.executable, issues_exec, '--profile', 'list'],
+                     cwd = self.repository, env = environ,
+                     stdout = PIPE, stderr = PIPE)
+        (output, report) = proc.communicate()
+        self.assertEqual(0, proc.returncode, report)
+        self.assert_('Profiled issue' in output)
+        self.assert_('Profile:' not in output)
+
+        lines = report.splitlines()
+        self.assert_(re.match(r'Profile: \d+\.\d{3}s in total$', lines[0]))
+        self.assertEqual('', lines[1])
+        self.assertEqual('  git command        calls    seconds    bytes in'
+                         '   bytes out errors', lines[2])
+        calls = {}
+        for i in range(3, len(lines)):
+            if not lines[i]:
+                break
+            match = re.match(r'  (\S+) +(\d+) +\d+\.\d{3} +\d+ +\d+ +\d+$',
+                             lines[i])
+            self.assert_(match, lines[i])
+            calls[match.group(1)] = int(match.group(2))
+
+        traced = {}
+        for line in open(trace):
+            match = re.search(r'trace: built-in: git (\S+)', line)
+            if match:
+                traced[match.group(1)] = traced.get(match.group(1), 0) + 1
+        self.assertEqual(traced, calls)
+
+        self.assertEqual('', lines[i])
+        self.assertEqual('  step               calls    seconds',
+                         lines[i + 1])
+        steps = [re.match(r'  (.+?) +(\d+) +\d+\.\d{3}$', line).group(1)
+                 for line in lines[i + 2:]]
+        self.assert_('cache load' in steps, steps)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -125,6 +125,686 @@ path: (apple/orange/baz3.c)
 path: (foo/bar/baz1.c)
 """, buf.getvalue())
 
+    def testGetMany(self):
+        shelf = gitshelve.open('test')
+        paths = []
+        for i in range(50):
+            path = 'foo/%02d/baz.c' % i
+            shelf[path] = "Text number %d\n" % i
+            paths.append(path)
+        shelf.commit('first\n')
+        del shelf
+
+        shelf = gitshelve.open('test')
+        data = shelf.get_many(paths)
+        self.assertEqual(50, len(data))
+        for i in range(50):
+            self.assertEqual("Text number %d\n" % i, data[i])
+        self.assertEqual("Text number 7\n", shelf['foo/07/baz.c'])
+
+        def foo5(shelf):
+            return shelf.get_many(['foo/01/baz.c', 'foo/99/baz.c'])
+        self.assertRaises(exceptions.KeyError, foo5, shelf)
+
+        shelf.close()
+        self.assertEqual(None, shelf.reader)
+
+    def testFastImport(self):
+        shelf = gitshelve.open('test', fast_import = True)
+        text = "Hello, this is a test\n"
+        shelf['foo/bar/baz1.c'] = text
+        shelf['foo/bar/baz2.c'] = text
+        shelf['foo/quux.c'] = text
+        shelf.sync()
+
+        buf = StringIO()
+        shelf.dump_objects(buf)
+        self.assertEqual("""tree f860c1f952b1e0e65bb50dd8a44ec45adf8f6f3c
+  tree a2690e16f8bb79b669b2ca437dda39db87f2633a: foo
+    tree 90f86c20cb0e45cd834e7f3eb8f95145c099d810: bar
+      blob ea93d5cc5f34e13d2a55a5866b75e2c58993d253: baz1.c
+      blob ea93d5cc5f34e13d2a55a5866b75e2c58993d253: baz2.c
+    blob ea93d5cc5f34e13d2a55a5866b75e2c58993d253: quux.c
+""", buf.getvalue())
+
+        del shelf['foo/bar/baz1.c']
+        hash1 = shelf.commit('second\n')
+        self.assertEqual(hash1, shelf.current_head())
+
+        parents = gitshelve.git('rev-list', '--parents', '--max-count=1',
+                                'test')
+        self.assertEqual(2, len(parents.split()))
+
+        del shelf
+        shelf = gitshelve.open('test')
+        keys = shelf.keys()
+        keys.sort()
+        self.assertEqual(['foo/bar/baz2.c', 'foo/quux.c'], keys)
+        self.assertEqual(text, shelf['foo/bar/baz2.c'])
+
+    def testWriteBook(self):
+        class noting_gitbook(gitshelve.gitbook):
+            __slots__ = ()
+
+            def change_comment(self):
+                return "Changed %s\n" % self.path
+
+        for fast_import in (False, True):
+            try: gitshelve.git('branch', '-D', 'test')
+            except: pass
+
+            shelf = gitshelve.open('test', book_type = noting_gitbook,
+                                   fast_import = fast_import)
+            shelf.retry_delay = 0
+            text = "Hello, this is a test\n"
+            shelf['foo/bar/baz1.c'] = text
+            shelf['foo/baz2.c'] = text
+            shelf.sync()
+
+            # A book written ahead is let go of, but still committed.
+            change = "Hello, this is a change\n"
+            shelf['foo/bar/baz1.c'] = change
+            shelf['foo/new/baz3.c'] = change
+            for path in ('foo/bar/baz1.c', 'foo/new/baz3.c'):
+                self.assertEqual(shelf.hash_blob(change),
+                                 shelf.write_book(path))
+                self.assertEqual(None, shelf.get_book(path).data)
+            self.assertEqual(True, shelf.dirty)
+
+            # Even when the commit is made again, on top of another writer's.
+            theirs = gitshelve.open('test')
+            theirs['alpha/baz4.c'] = change
+            theirs.sync()
+
+            shelf.commit("Change\n")
+            self.assertEqual([theirs.head], shelf.get_parent_ids())
+            self.assertEqual("Change\n\nChanged foo/bar/baz1.c\n"
+                             "Changed foo/new/baz3.c\n",
+                             gitshelve.git('log', '-1', '--format=%B',
+                                           'test'))
+
+            shelf = gitshelve.open('test')
+            keys = shelf.keys()
+            keys.sort()
+            self.assertEqual(['alpha/baz4.c', 'foo/bar/baz1.c', 'foo/baz2.c',
+                              'foo/new/baz3.c'], keys)
+            self.assertEqual(change, shelf['foo/bar/baz1.c'])
+            self.assertEqual(change, shelf['foo/new/baz3.c'])
+            self.assertEqual(text, shelf['foo/baz2.c'])
+
+    def testLazy(self):
+        shelf = gitshelve.open('test')
+        text = "Hello, this is a test\n"
+        shelf['foo/bar/baz1.c'] = text
+        shelf['foo/bar/baz2.c'] = text
+        shelf['alpha/beta/baz3.c'] = text
+        shelf.sync()
+
+        buf = StringIO()
+        shelf.dump_objects(buf)
+        expected = buf.getvalue()
+        del shelf
+
+        shelf = gitshelve.open('test', lazy = True)
+        self.assertEqual(['__root__'], shelf.objects['foo'].keys())
+        self.assertEqual(['__root__'], shelf.objects['alpha'].keys())
+
+        self.assertEqual(text, shelf['foo/bar/baz2.c'])
+        self.assertEqual(['__root__'], shelf.objects['alpha'].keys())
+        self.assert_('baz1.c' in shelf.objects['foo']['bar'])
+
+        # Clean trees which were never read are reused by name.
+        shelf['foo/bar/baz1.c'] = "Hello, this is a change\n"
+        shelf.sync()
+        self.assertEqual(['__root__'], shelf.objects['alpha'].keys())
+        shelf['foo/bar/baz1.c'] = text
+        shelf.sync()
+
+        buf = StringIO()
+        shelf.dump_objects(buf)
+        self.assertEqual(expected, buf.getvalue())
+        del shelf
+
+        shelf = gitshelve.open('test', lazy = True)
+        keys = shelf.keys()
+        keys.sort()
+        self.assertEqual(['alpha/beta/baz3.c', 'foo/bar/baz1.c',
+                          'foo/bar/baz2.c'], keys)
+        del shelf
+
+        shelf = gitshelve.open('test', lazy = True)
+        del shelf['foo/bar/baz1.c']
+        shelf.sync()
+        self.assertEqual(['__root__'], shelf.objects['alpha'].keys())
+        del shelf
+
+        shelf = gitshelve.open('test')
+        keys = shelf.keys()
+        keys.sort()
+        self.assertEqual(['alpha/beta/baz3.c', 'foo/bar/baz2.c'], keys)
+
+    def testCompactBooks(self):
+        shelf = gitshelve.open('test')
+        text = "Hello, this is a test\n"
+        shelf['foo/bar/baz.c'] = text
+        shelf['foo/quux.c'] = text
+        shelf.sync()
+        del shelf
+
+        shelf = gitshelve.open('test')
+        book = shelf.objects['foo']['bar']['baz.c']
+        self.assert_(isinstance(book, gitshelve.gitbook))
+        self.assert_(not hasattr(book, '__dict__'))
+        self.assert_(book is shelf.get_tree('foo/bar/baz.c'))
+        self.assert_(intern('baz.c') is
+                     [key for key in shelf.objects['foo']['bar']
+                      if key != '__root__'][0])
+
+        self.assert_('foo/quux.c' in shelf)
+        self.assert_('foo/bar' not in shelf)
+        self.assert_('foo/nothing.c' not in shelf)
+        self.assertRaises(exceptions.KeyError, shelf.get_tree,
+                          'foo/quux.c/baz.c')
+
+        # A book standing in the way of a new file becomes a tree.
+        shelf['foo/quux.c/baz.c'] = text
+        shelf.sync()
+        keys = shelf.keys()
+        keys.sort()
+        self.assertEqual(['foo/bar/baz.c', 'foo/quux.c/baz.c'], keys)
+
+    def testCache(self):
+        shelf = gitshelve.open('test')
+        for i in range(10):
+            shelf['foo/%d.txt' % i] = "Text number %d\n" % i
+        shelf.sync()
+        del shelf
+
+        shelf = gitshelve.open('test', cache_entries = 3)
+        for i in range(10):
+            self.assertEqual("Text number %d\n" % i,
+                             shelf['foo/%d.txt' % i])
+        self.assertEqual("Text number 9\n", shelf['foo/9.txt'])
+        books = shelf.objects['foo']
+        self.assertEqual([None] * 7,
+                         [books['%d.txt' % i].data for i in range(7)])
+        stats = shelf.cache.stats()
+        self.assertEqual((1, 10, 7, 3), (stats['hits'], stats['misses'],
+                                         stats['evictions'],
+                                         stats['entries']))
+
+        # Dirty books are never dropped, and are kept track of again once
+        # they have been committed.
+        for i in range(5) + [8]:
+            shelf['foo/%d.txt' % i] = "Changed %d\n" % i
+        self.assertEqual(['foo/7.txt', 'foo/9.txt'],
+                         [book.path for book in shelf.cache.books])
+        self.assertEqual(["Changed %d\n" % i for i in range(5)],
+                         shelf.get_many(['foo/%d.txt' % i
+                                         for i in range(5)]))
+        shelf.sync()
+        self.assertEqual(3, len(shelf.cache.books))
+        for book in books.values():
+            if isinstance(book, gitshelve.gitbook):
+                self.assert_(not book.dirty)
+                self.assertEqual(book.data is not None,
+                                 book in shelf.cache.books)
+        self.assertEqual("Changed 0\n", shelf['foo/0.txt'])
+        del shelf
+
+        shelf = gitshelve.open('test', cache_bytes = 30)
+        shelf.get_many(['foo/%d.txt' % i for i in range(5)])
+        self.assertEqual(30, shelf.cache.stats()['bytes'])
+        self.assertEqual(3, len(shelf.cache.books))
+
+    def testRangeScan(self):
+        shelf = gitshelve.open('test')
+        for key in ('ab/cd/issue.xml', 'ab/cd/comment_1.xml', 'ab/ef.xml',
+                    'ab-x.xml', 'ac/gh/issue.xml', 'b.xml'):
+            shelf[key] = "Data for %s\n" % key
+        shelf.sync()
+        del shelf
+
+        shelf = gitshelve.open('test', lazy = True)
+        keys = [key for (key, book) in shelf.iterprefix('ab/')]
+        self.assertEqual(['ab/cd/comment_1.xml', 'ab/cd/issue.xml',
+                          'ab/ef.xml'], keys)
+        self.assertEqual(['__root__'], shelf.objects['ac'].keys())
+
+        keys = [key for (key, book) in shelf.iterprefix('ab')]
+        self.assertEqual(['ab-x.xml', 'ab/cd/comment_1.xml',
+                          'ab/cd/issue.xml', 'ab/ef.xml'], keys)
+        self.assertEqual(['__root__'], shelf.objects['ac'].keys())
+
+        keys = [key for (key, book) in shelf.iterrange('ab/cd/issue.xml',
+                                                       'ac/gh/issue.xml')]
+        self.assertEqual(['ab/cd/issue.xml', 'ab/ef.xml'], keys)
+
+        keys = [key for (key, book) in shelf.iterrange('ab/d')]
+        self.assertEqual(['ab/ef.xml', 'ac/gh/issue.xml', 'b.xml'], keys)
+        self.assertEqual([], list(shelf.iterprefix('zz')))
+
+        items = list(shelf.iterprefix('', prefetch = 4))
+        self.assertEqual(6, len(items))
+        for (key, book) in items:
+            self.assertEqual("Data for %s\n" % key, book.data)
+
+        # A tree which was scanned can be forgotten, unless it holds changes.
+        self.assertEqual(True, shelf.unload_tree('ab'))
+        self.assertEqual(['__root__'], shelf.objects['ab'].keys())
+        shelf['ac/gh/new.xml'] = "New\n"
+        self.assertEqual(False, shelf.unload_tree('ac'))
+        self.assertEqual(False, shelf.unload_tree('b.xml'))
+        self.assertEqual("Data for ab/ef.xml\n", shelf['ab/ef.xml'])
+
+        # A prefix may end in characters which cannot be incremented.
+        for key in ('b\xff.xml', 'b\xff\xffc.xml', '\xff\xff.xml'):
+            shelf[key] = "Data for %s\n" % key
+        keys = [key for (key, book) in shelf.iterprefix('b\xff')]
+        self.assertEqual(['b\xff.xml', 'b\xff\xffc.xml'], keys)
+        keys = [key for (key, book) in shelf.iterprefix('\xff')]
+        self.assertEqual(['\xff\xff.xml'], keys)
+
+    def testHooks(self):
+        calls = []
+        def hook(cmd, args, seconds, bytes_in, bytes_out, status):
+            calls.append((cmd, bytes_in, bytes_out, status))
+        gitshelve.hooks.append(hook)
+        try:
+            text = "Hello, this is a test\n"
+            shelf = gitshelve.open('test', fast_import = True)
+            shelf['foo/bar/baz.c'] = text
+            shelf.sync()
+            del shelf
+
+            shelf = gitshelve.open('test')
+            self.assertEqual(text, shelf['foo/bar/baz.c'])
+            gitshelve.git('cat-file', '-e', 'test:nothing',
+                          ignore_errors = True)
+        finally:
+            gitshelve.hooks.remove(hook)
+
+        commands = [cmd for (cmd, bytes_in, bytes_out, status) in calls]
+        self.assert_('fast-import' in commands)
+        self.assert_('ls-tree' in commands)
+        for (cmd, bytes_in, bytes_out, status) in calls:
+            if cmd == 'fast-import':
+                self.assert_(bytes_in > len(text))
+                self.assertEqual(0, status)
+        blob = 'ea93d5cc5f34e13d2a55a5866b75e2c58993d253'
+        self.assert_(('cat-file', len(blob) + 1, len(text), 0) in calls)
+        self.assertNotEqual(0, calls[-1][3])
+
+    def testRefresh(self):
+        for lazy in (False, True):
+            try: gitshelve.git('branch', '-D', 'test')
+            except: pass
+
+            shelf = gitshelve.open('test')
+            text = "Hello, this is a test\n"
+            shelf['foo/bar/baz1.c'] = text
+            shelf['foo/bar/baz2.c'] = text
+            shelf['alpha/beta/baz3.c'] = text
+            shelf['alpha/gamma/baz4.c'] = text
+            shelf.sync()
+
+            mine = gitshelve.open('test', lazy = lazy)
+            self.assertEqual(text, mine['alpha/beta/baz3.c'])
+            data = mine['alpha/beta/baz3.c']
+            self.assertEqual(False, mine.refresh())
+
+            change = "Hello, this is a change\n"
+            shelf['foo/bar/baz1.c'] = change
+            shelf['foo/new/baz5.c'] = change
+            del shelf['alpha/gamma/baz4.c']
+            shelf.sync()
+
+            self.assertEqual(True, mine.refresh())
+            self.assertEqual(shelf.head, mine.head)
+            self.assert_(data is mine['alpha/beta/baz3.c'])
+            self.assertEqual(change, mine['foo/bar/baz1.c'])
+            self.assertEqual(change, mine['foo/new/baz5.c'])
+
+            keys = mine.keys()
+            keys.sort()
+            self.assertEqual(['alpha/beta/baz3.c', 'foo/bar/baz1.c',
+                              'foo/bar/baz2.c', 'foo/new/baz5.c'], keys)
+
+            mine['alpha/beta/baz3.c'] = change
+            mine.sync()
+            del mine
+            del shelf
+
+            buf = StringIO()
+            shelf = gitshelve.open('test')
+            shelf.dump_objects(buf)
+            self.assertEqual("""tree b2919a2e415f7d86426e160d44ce96131be0639c: alpha
+  tree a722f63f70eb207e5a16d71703d76a6ae0903c52: beta
+    blob fb54a7573d864d4b57ffcc8af37e7565e2ba4608: baz3.c
+tree 387018e5b23975abfbb1df39c213fe561c570b4d: foo
+  tree 8a0380b2d604684ce60b734fb7971e7477647bcc: bar
+    blob fb54a7573d864d4b57ffcc8af37e7565e2ba4608: baz1.c
+    blob ea93d5cc5f34e13d2a55a5866b75e2c58993d253: baz2.c
+  tree d501900da3aed3539bda854b984073c955cc02df: new
+    blob fb54a7573d864d4b57ffcc8af37e7565e2ba4608: baz5.c
+""", buf.getvalue())
+            del shelf
+
+    def testRebase(self):
+        for fast_import in (False, True):
+            try: gitshelve.git('branch', '-D', 'test')
+            except: pass
+
+            shelf = gitshelve.open('test')
+            text = "Hello, this is a test\n"
+            shelf['foo/bar/baz1.c'] = text
+            shelf['foo/bar/baz2.c'] = text
+            shelf['alpha/beta/baz3.c'] = text
+            shelf.sync()
+
+            mine = gitshelve.open('test', fast_import = fast_import)
+            mine.retry_delay = 0
+            theirs = gitshelve.open('test')
+
+            change = "Hello, this is a change\n"
+            theirs['foo/bar/baz1.c'] = change
+            theirs['foo/new/baz4.c'] = change
+            theirs.sync()
+
+            mine['foo/bar/baz2.c'] = change
+            del mine['alpha/beta/baz3.c']
+            mine['alpha/gamma/baz5.c'] = change
+            mine.sync()
+            self.assertEqual([theirs.head],
+                             mine.get_parent_ids())
+
+            shelf = gitshelve.open('test')
+            keys = shelf.keys()
+            keys.sort()
+            self.assertEqual(['alpha/gamma/baz5.c', 'foo/bar/baz1.c',
+                              'foo/bar/baz2.c', 'foo/new/baz4.c'], keys)
+            self.assertEqual(change, shelf['foo/bar/baz1.c'])
+            self.assertEqual(change, shelf['foo/bar/baz2.c'])
+
+            # The same book changed on both sides cannot be rebased, and
+            # neither can a book in a tree removed on the other side.
+            for (path, other) in (('foo/bar/baz1.c', 'foo/bar/baz1.c'),
+                                  ('foo/new/baz4.c', 'foo/new')):
+                mine = gitshelve.open('test', fast_import = fast_import)
+                mine.retry_delay = 0
+                theirs = gitshelve.open('test')
+                theirs[path] = text
+                theirs.sync()
+
+                del mine[other]
+                try:
+                    mine.sync()
+                    self.fail("The commit did not conflict")
+                except gitshelve.GitConflict, e:
+                    self.assertEqual([other], e.paths)
+                self.assertEqual(theirs.head, gitshelve.open('test').head)
+                self.assertEqual(True, mine.dirty)
+
+    def testMerge(self):
+        try:
+            shelf = gitshelve.open('test')
+            text = "Hello, this is a test\n"
+            shelf['foo/bar/baz1.c'] = text
+            shelf['foo/bar/baz2.c'] = text
+            shelf['alpha/beta/baz3.c'] = text
+            shelf['alpha/gamma/baz4.c'] = text
+            shelf.sync()
+            base = shelf.head
+            gitshelve.git('branch', '-f', 'test-theirs', 'test')
+
+            change = "Hello, this is a change\n"
+            theirs = gitshelve.open('test-theirs')
+            theirs['foo/bar/baz1.c'] = change
+            theirs['foo/new/baz5.c'] = change
+            del theirs['alpha/gamma']
+            theirs.sync()
+
+            # Moving forward to a descendant makes no merge commit.
+            behind = gitshelve.open('test-behind')
+            gitshelve.git('branch', '-f', 'test-behind', base)
+            behind.refresh()
+            self.assertEqual(theirs.head, behind.merge('test-theirs'))
+            self.assertEqual(change, behind['foo/new/baz5.c'])
+
+            shelf['foo/bar/baz2.c'] = change
+            shelf['alpha/beta/baz3.c'] = change
+            shelf.sync()
+            ours = shelf.head
+
+            head = shelf.merge('test-theirs')
+            self.assertEqual([ours, theirs.head], shelf.get_parent_ids())
+            self.assertEqual(head, shelf.merge('test-theirs'))
+
+            shelf = gitshelve.open('test')
+            keys = shelf.keys()
+            keys.sort()
+            self.assertEqual(['alpha/beta/baz3.c', 'foo/bar/baz1.c',
+                              'foo/bar/baz2.c', 'foo/new/baz5.c'], keys)
+            for key in keys:
+                self.assertEqual(change, shelf[key])
+
+            # A book changed on both sides is only merged by resolve.
+            shelf['foo/bar/baz1.c'] = "Ours\n"
+            shelf.sync()
+            theirs['foo/bar/baz1.c'] = "Theirs\n"
+            theirs['foo/new/baz6.c'] = "Theirs\n"
+            theirs.sync()
+
+            try:
+                shelf.merge('test-theirs')
+                self.fail("The merge did not conflict")
+            except gitshelve.GitConflict, e:
+                self.assertEqual(['foo/bar/baz1.c'], e.paths)
+            self.assertEqual("Ours\n", shelf['foo/bar/baz1.c'])
+
+            def resolve(path, base, ours, theirs):
+                self.assertEqual(('foo/bar/baz1.c', change), (path, base))
+                return ours + theirs
+            shelf.merge('test-theirs', resolve)
+            shelf = gitshelve.open('test')
+            self.assertEqual("Ours\nTheirs\n", shelf['foo/bar/baz1.c'])
+            self.assertEqual("Theirs\n", shelf['foo/new/baz6.c'])
+        finally:
+            for branch in ('test-theirs', 'test-behind'):
+                try: gitshelve.git('branch', '-D', branch)
+                except: pass
+
+    def testConcurrentWriters(self):
+        """Several processes committing to the same branch at once all get
+        their work in, each commit on top of the one before."""
+        writers = 6
+        commits = 5
+        script  = """
+import sys
+import gitshelve
+
+writer = int(sys.argv[1])
+shelf  = gitshelve.open('test', fast_import = writer %% 2 == 1)
+for i in range(%d):
+    shelf['shared/%%d/%%d.txt' %% (writer, i)] = 'Commit %%d\\n' %% i
+    shelf.commit('Writer %%d, commit %%d\\n' %% (writer, i))
+""" % commits
+
+        shelf = gitshelve.open('test')
+        shelf['README'] = 'The shared branch\n'
+        shelf.sync()
+
+        here  = os.path.dirname(os.path.abspath(__file__))
+        procs = []
+        for writer in range(writers):
+            procs.append(gitshelve.Popen([sys.executable, '-c', script,
+                                          str(writer)], cwd = os.getcwd(),
+                                         env = dict(os.environ,
+                                                    PYTHONPATH = here)))
+        for proc in procs:
+            self.assertEqual(0, proc.wait())
+
+        shelf = gitshelve.open('test')
+        self.assertEqual(writers * commits + 1, len(shelf.keys()))
+        for writer in range(writers):
+            for i in range(commits):
+                self.assertEqual('Commit %d\n' % i,
+                                 shelf['shared/%d/%d.txt' % (writer, i)])
+        history = gitshelve.git('rev-list', '--first-parent', 'test')
+        self.assertEqual(writers * commits + 1, len(history.split()))
+
+    def testDiffHeads(self):
+        shelf = gitshelve.open('test')
+        text = "Hello, this is a test\n"
+        shelf['foo/bar/baz1.c'] = text
+        shelf['foo/baz2.c'] = text
+        shelf.sync()
+        first = shelf.head
+        blob  = shelf.get_book('foo/baz2.c').name
+
+        self.assertEqual([('A', '100644', blob, 'foo/bar/baz1.c', '0' * 40),
+                          ('A', '100644', blob, 'foo/baz2.c', '0' * 40)],
+                         shelf.diff_heads(shelf.empty_tree(), first,
+                                          old_names = True))
+        self.assertEqual([('A', '100644', blob, 'foo/bar/baz1.c')],
+                         shelf.diff_heads(shelf.empty_tree(), first,
+                                          paths = [':(glob)*/*/baz1.c']))
+
+        shelf['foo/baz2.c'] = "Hello, this is a change\n"
+        del shelf['foo/bar/baz1.c']
+        shelf.sync()
+        self.assertEqual([('D', '000000', '0' * 40, 'foo/bar/baz1.c', blob),
+                          ('M', '100644', shelf.get_book('foo/baz2.c').name,
+                           'foo/baz2.c', blob)],
+                         shelf.diff_heads(first, shelf.head,
+                                          old_names = True))
+
+    def testAddFile(self):
+        filename = os.path.join(self.tmpdir, 't_gitshelve_file')
+        text = "Hello, this is a file\n" * 1000
+        fd = open(filename, 'wb')
+        fd.write(text)
+        fd.close()
+
+        try:
+            shelf = gitshelve.open('test')
+            name  = shelf.add_file('foo/bar/file', filename)
+            self.assertEqual(gitshelve.git('hash-object', filename), name)
+            shelf.sync()
+        finally:
+            os.unlink(filename)
+
+        shelf = gitshelve.open('test')
+        self.assertEqual(text, shelf['foo/bar/file'])
+
+        buf = StringIO()
+        self.assertEqual(len(text), shelf.write_blob(name, buf, 100))
+        self.assertEqual(text, buf.getvalue())
+
+        self.assertRaises(gitshelve.GitError, shelf.write_blob, '0' * 40, buf)
+
+    def testTouch(self):
+        class upper_gitbook(gitshelve.gitbook):
+            def serialize_data(self, data):
+                return data.upper()
+
+        shelf = gitshelve.open('test')
+        text = "Hello, this is a test\n"
+        shelf['foo/bar/baz.c'] = text
+        shelf.sync()
+
+        shelf.book_type = upper_gitbook
+        shelf.touch('foo/bar/baz.c')
+        self.assertEqual(True, shelf.dirty)
+        shelf.sync()
+
+        data = gitshelve.git('cat-file', 'blob', 'test:foo/bar/baz.c',
+                             keep_newline = True)
+        self.assertEqual(text.upper(), data)
+
+        # Data changed in place is written as given, even once the book has
+        # let go of it.
+        shelf = gitshelve.open('test', book_type = upper_gitbook,
+                               cache_entries = 1)
+        shelf['foo/bar/other.c'] = "Other\n"
+        shelf.sync()
+        shelf['foo/bar/baz.c']
+        shelf['foo/bar/other.c']
+        self.assertEqual(None, shelf.get_book('foo/bar/baz.c').data)
+        shelf.touch('foo/bar/baz.c', "Changed\n")
+        shelf.sync()
+        self.assertEqual("CHANGED\n",
+                         gitshelve.git('cat-file', 'blob', 'test:foo/bar/baz.c',
+                                       keep_newline = True))
+
+        def foo6(shelf):
+            shelf.touch('foo/bar')
+        self.assertRaises(exceptions.KeyError, foo6, shelf)
+
+    def testChangeComment(self):
+        class noting_gitbook(gitshelve.gitbook):
+            def change_comment(self):
+                return "Changed %s\n" % self.path
+
+        for fast_import in (False, True):
+            try: gitshelve.git('branch', '-D', 'test')
+            except: pass
+
+            shelf = gitshelve.open('test', book_type = noting_gitbook,
+                                   fast_import = fast_import)
+            shelf['foo/bar/baz.c'] = "Hello, this is a test\n"
+            shelf.commit()
+            self.assertEqual("Changed foo/bar/baz.c\n",
+                             gitshelve.git('log', '-1', '--format=%B', 'test'))
+
+            shelf['foo/bar/baz.c'] = "Hello, this is a change\n"
+            shelf.commit("Change baz.c\n")
+            self.assertEqual("Change baz.c\n\nChanged foo/bar/baz.c\n",
+                             gitshelve.git('log', '-1', '--format=%B', 'test'))
+
+    def testDirtyPaths(self):
+        for fast_import in (False, True):
+            shelf = gitshelve.open('test', fast_import = fast_import)
+            for i in range(10):
+                shelf['tree%d/sub/file.txt' % i] = "File %d\n" % i
+            shelf['top.txt'] = "Top\n"
+            shelf.sync()
+            self.assertEqual(set(), shelf.dirty_paths)
+
+            visited = []
+            if fast_import:
+                import_tree = shelf.import_tree
+                def counter(proc, objects, path, *args):
+                    visited.append(path)
+                    return import_tree(proc, objects, path, *args)
+                shelf.import_tree = counter
+            else:
+                make_tree = shelf.make_tree
+                def counter(objects, comment_accumulator = None, path = '',
+                            dirty = None):
+                    visited.append(path)
+                    return make_tree(objects, comment_accumulator, path, dirty)
+                shelf.make_tree = counter
+
+            shelf['tree3/sub/file.txt'] = "Changed\n"
+            del shelf['tree7']
+            self.assertEqual(set(['tree3/sub/file.txt', 'tree7']),
+                             shelf.dirty_paths)
+            shelf.sync()
+            self.assertEqual(['', 'tree3', 'tree3/sub'], sorted(visited))
+
+            data = gitshelve.git('ls-tree', '-r', '--name-only', 'test')
+            self.assertEqual(['top.txt'] +
+                             ['tree%d/sub/file.txt' % i
+                              for i in range(10) if i != 7],
+                             data.split('\n'))
+            self.assertEqual("Changed\n",
+                             gitshelve.git('cat-file', 'blob',
+                                           'test:tree3/sub/file.txt',
+                                           keep_newline = True))
+            del shelf
+            gitshelve.git('branch', '-D', 'test')
+
     def testVersioning(self):
         shelf = gitshelve.open('test')
         text = "Hello, this is a test\n"
@@ -247,6 +927,38 @@ Date:   .+
             if os.path.isdir(blobpath):
                 shutil.rmtree(blobpath)
 
+    def testHashBlob(self):
+        shelf = gitshelve.open('test')
+        for text in ("", "Hello, this is a test\n", "x" * 10000):
+            self.assertEqual(gitshelve.git('hash-object', '--stdin',
+                                           input = text),
+                             shelf.hash_blob(text))
+
+    def testSha256Repo(self):
+        repotest = os.path.join(self.tmpdir, 'repo-test-sha256')
+        try:
+            gitshelve.git('init', '--bare', '--object-format=sha256',
+                          repotest)
+            shelf = gitshelve.open(repository = repotest)
+            text = "Hello, world!\n"
+            self.assertEqual('sha256', shelf.get_object_format())
+            self.assertEqual(gitshelve.git('hash-object', '--stdin',
+                                           repository = repotest,
+                                           input = text),
+                             shelf.hash_blob(text))
+
+            shelf['foo/bar.txt'] = text
+            shelf.sync()
+            self.assertEqual(64, len(shelf.head))
+            del shelf
+
+            shelf = gitshelve.open(repository = repotest)
+            self.assertEqual(text, shelf['foo/bar.txt'])
+            del shelf
+        finally:
+            if os.path.isdir(repotest):
+                shutil.rmtree(repotest)
+
 def suite():
     return unittest.TestLoader().loadTestsFromTestCase(t_gitshelve)
 